@@ -0,0 +1,563 @@
+"""
+End-to-end load test of server.py. The server is started (with authentication
+and sessions enabled) on a temporary copy of src/, with the OMDb, dog.ceo,
+thecatapi and random-d APIs replaced by a local stand-in with configurable
+latency and failure rate, so nothing leaves the machine. A number of virtual
+users, each with its own session, then drive a weighted mix of:
+
+    static   GET of a page, script, stylesheet or image
+    submit   POST /submit of a random form
+    analyze  POST /analyze (after a submit), polling the job until it is done
+    view     GET /view/input or /view/profile
+
+Throughput, latency percentiles and error rates are reported per operation as
+JSON, so runs before and after a change can be compared. Requests that fail to
+complete or get a 5xx response are errors; other statuses (e.g. a 400 for
+viewing a profile before it exists) are counted but not errors. `analyze_job`
+is the time from POST /analyze until the job finished.
+
+Run from the repository root, e.g.
+    python bench/loadtest.py -c 16 -d 30 --upstream-latency 50 -o run.json
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import signal
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.server
+from urllib.parse import urlsplit, parse_qs
+
+import requests
+
+
+DESC = "Load test of the psych app server against stub upstream APIs."
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'src')
+
+# Left out of the copy of src/ the server runs on
+RUNTIME_FILES = ('__pycache__', 'data', 'images', 'cache', 'profiles',
+                 'session.key')
+
+STATIC_PATHS = ('/', '/form', '/main.js', '/style.css', '/logo.png',
+                '/favicon.ico')
+VIEW_PATHS = ('/view/input', '/view/profile')
+OPS = ('static', 'submit', 'analyze', 'view')
+DEFAULT_MIX = 'static=6,submit=2,analyze=1,view=3'
+
+PETS = ('dog', 'cat', 'duck')
+N_QUESTIONS = 20
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """ Answers as each upstream API would, after an injected delay """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        stubs = self.server.stubs
+        url = urlsplit(self.path)
+        endpoint = url.path.strip('/').split('/')[0]
+        stubs.count(endpoint)
+
+        if stubs.latency or stubs.jitter:
+            time.sleep((stubs.latency + random.random() * stubs.jitter) / 1000)
+        if random.random() < stubs.fail_rate:
+            self.reply(503, b'{"error": "injected failure"}')
+            return
+
+        base = f'http://{self.headers["Host"]}'
+        n = random.randrange(stubs.n_images)
+        if endpoint == 'omdb':
+            query = parse_qs(url.query)
+            title = query.get('t', ['?'])[0]
+            body = {
+                'Title': title,
+                'Year': query.get('y', ['?'])[0],
+                'Plot': f'A film about {title}.',
+                'Poster': f'{base}/img/poster-{n}.jpg',
+                'Response': 'True',
+            }
+        elif endpoint == 'dog':
+            body = {'message': f'{base}/img/dog-{n}.jpg', 'status': 'success'}
+        elif endpoint == 'cat':
+            body = [{'url': f'{base}/img/cat-{n}.jpg'}]
+        elif endpoint == 'duck':
+            body = {'url': f'{base}/img/duck-{n}.jpg'}
+        elif endpoint == 'img':
+            # Distinct content per name, so the image store keeps each one
+            name = url.path.encode()
+            self.reply(200, stubs.image + name, 'image/jpeg')
+            return
+        else:
+            self.reply(404, b'{}')
+            return
+
+        self.reply(200, json.dumps(body).encode())
+
+    def reply(self, status: int, body: bytes,
+              content_type: str = 'application/json') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address) -> None:
+        # e.g. the server closing a pooled connection
+        pass
+
+
+class StubUpstreams:
+    """ Local stand-in for every API in DataFetcher.apis """
+
+    def __init__(self,
+                 latency: float = 0,
+                 jitter: float = 0,
+                 fail_rate: float = 0,
+                 image_size: int = 16 * 1024,
+                 n_images: int = 50):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.image = os.urandom(image_size)
+        self.n_images = n_images
+        self.counts = {}
+        self.lock = threading.Lock()
+
+        self.httpd = StubServer(('127.0.0.1', 0), StubHandler)
+        self.httpd.stubs = self
+        self.base = f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def count(self, endpoint: str) -> None:
+        with self.lock:
+            self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+
+    def env(self) -> dict[str, str]:
+        # Environment variables pointing DataFetcher at the stubs
+        return {
+            'PSYCH_OMDB_API': f'{self.base}/omdb/',
+            'PSYCH_DOG_API': f'{self.base}/dog',
+            'PSYCH_CAT_API': f'{self.base}/cat',
+            'PSYCH_DUCK_API': f'{self.base}/duck',
+        }
+
+    def start(self) -> None:
+        threading.Thread(target=self.httpd.serve_forever, name='stubs',
+                         daemon=True).start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class ServerProcess:
+    """ server.py running on a temporary copy of src/ """
+
+    def __init__(self, server_args: list[str], env: dict[str, str],
+                 keep_dir: bool = False):
+        self.workdir = tempfile.mkdtemp(prefix='psych-loadtest-')
+        self.keep_dir = keep_dir
+        self.port = free_port()
+        self.base = f'http://127.0.0.1:{self.port}'
+
+        src = os.path.join(self.workdir, 'src')
+        shutil.copytree(SRC_DIR, src,
+                        ignore=shutil.ignore_patterns(*RUNTIME_FILES))
+        self.log_path = os.path.join(self.workdir, 'server.log')
+        self.log = open(self.log_path, 'w')
+        self.proc = subprocess.Popen(
+            [sys.executable, '-u', 'server.py', '-p', str(self.port),
+             *server_args],
+            cwd=src, env={**os.environ, **env},
+            stdout=self.log, stderr=subprocess.STDOUT
+        )
+
+    def wait_ready(self, timeout: float = 30) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'Server exited with {self.proc.returncode}'
+                                   f', see {self.log_path}')
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.5).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f'Server not ready after {timeout}s')
+
+    def stop(self) -> None:
+        if self.proc.poll() is None:
+            # SIGINT, so the server shuts down as after Ctrl-C
+            self.proc.send_signal(signal.SIGINT)
+            try:
+                self.proc.wait(10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.log.close()
+        if not self.keep_dir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class Recorder:
+    """ Latencies and statuses of the requests of each operation """
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.enabled = False
+
+    def record(self, op: str, latency: float, status: int | None) -> None:
+        # `status` is None if the request did not complete
+        if not self.enabled:
+            return
+        with self.lock:
+            self.samples.setdefault(op, []).append((latency, status))
+
+    def summary(self, elapsed: float) -> dict:
+        with self.lock:
+            samples = {op: list(s) for op, s in self.samples.items()}
+
+        ops = {op: summarise(s, elapsed) for op, s in sorted(samples.items())}
+        # Totals are of HTTP requests, so exclude the derived job timings
+        requests = [x for op, s in samples.items() if op != 'analyze_job'
+                    for x in s]
+        return {'total': summarise(requests, elapsed), 'ops': ops}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    # Nearest-rank percentile
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def is_error(status: int | None) -> bool:
+    return status is None or status >= 500
+
+
+def summarise(samples: list[tuple[float, int | None]], elapsed: float) -> dict:
+    latencies = sorted(latency for latency, _ in samples)
+    statuses = {}
+    for _, status in samples:
+        key = str(status) if status is not None else 'error'
+        statuses[key] = statuses.get(key, 0) + 1
+    n = len(samples)
+    errors = sum(is_error(status) for _, status in samples)
+    ms = lambda s: round(1000 * s, 3)
+
+    return {
+        'count': n,
+        'rps': round(n / elapsed, 2) if elapsed else 0.0,
+        'errors': errors,
+        'error_rate': round(errors / n, 4) if n else 0.0,
+        'statuses': statuses,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / n) if n else 0.0,
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1]) if n else 0.0,
+        },
+    }
+
+
+def random_form(jobs: list[str]) -> dict:
+    form = {f'question{q}': str(random.randint(1, 5))
+            for q in range(1, N_QUESTIONS + 1)}
+    form['job'] = random.choice(jobs)
+    form['pets'] = random.sample(PETS, random.randint(0, len(PETS)))
+    form['name'] = 'Load Test'
+    return form
+
+
+class VirtualUser:
+    """ A client with its own session, performing operations in turn """
+
+    def __init__(self, base: str, auth: tuple[str, str], recorder: Recorder,
+                 stop: threading.Event, jobs: list[str], timeout: float,
+                 job_timeout: float, poll_interval: float):
+        self.base = base
+        self.recorder = recorder
+        self.stop = stop
+        self.jobs = jobs
+        self.timeout = timeout
+        self.job_timeout = job_timeout
+        self.poll_interval = poll_interval
+        self.submitted = False
+
+        self.session = requests.Session()
+        # The first response sets a session cookie used from then on
+        self.session.auth = auth
+
+    def request(self, op: str, method: str, path: str,
+                **kwargs) -> requests.Response | None:
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base + path,
+                                            timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            self.recorder.record(op, time.perf_counter() - start, None)
+            return None
+        self.recorder.record(op, time.perf_counter() - start,
+                             response.status_code)
+        return response
+
+    def run(self, op: str) -> None:
+        getattr(self, f'do_{op}')()
+
+    def do_static(self) -> None:
+        self.request('static', 'GET', random.choice(STATIC_PATHS))
+
+    def do_view(self) -> None:
+        self.request('view', 'GET', random.choice(VIEW_PATHS))
+
+    def do_submit(self) -> None:
+        response = self.request('submit', 'POST', '/submit',
+                                json=random_form(self.jobs))
+        if response is not None and response.status_code == 200:
+            self.submitted = True
+
+    def do_analyze(self) -> None:
+        if not self.submitted:
+            self.do_submit()
+
+        start = time.perf_counter()
+        response = self.request('analyze', 'POST', '/analyze', data=b'null',
+                                headers={'Content-Type': 'application/json'})
+        if response is None or response.status_code not in (200, 202):
+            return
+        self.submitted = False
+
+        status = response.status_code
+        if status == 202:
+            status = self.wait_for_job(response.headers.get('Location'))
+            if self.stop.is_set():
+                # The run ended before the job
+                return
+        self.recorder.record('analyze_job', time.perf_counter() - start,
+                             status)
+
+    def wait_for_job(self, location: str | None) -> int | None:
+        # Returns 200 once the job is done, 500 if it failed and None if
+        # it could not be followed
+        if location is None:
+            return None
+        deadline = time.monotonic() + self.job_timeout
+        while time.monotonic() < deadline and not self.stop.is_set():
+            time.sleep(self.poll_interval)
+            response = self.request('poll', 'GET', location)
+            if response is None or response.status_code != 200:
+                return None
+            state = response.json().get('state')
+            if state == 'done':
+                return 200
+            if state == 'failed':
+                return 500
+        return None
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(','):
+        op, _, weight = item.partition('=')
+        if op.strip() not in OPS:
+            raise argparse.ArgumentTypeError(f'unknown operation `{op}`, '
+                                             f'expected one of {OPS}')
+        weights[op.strip()] = float(weight or 1)
+    return weights
+
+
+def run_load(args: argparse.Namespace, base: str, jobs: list[str]) -> dict:
+    recorder = Recorder()
+    ops, weights = zip(*args.mix.items())
+    auth = (args.user, args.password)
+    stop = threading.Event()
+    issued = iter(range(args.requests)) if args.requests else None
+    issued_lock = threading.Lock()
+
+    def next_op() -> str | None:
+        if stop.is_set():
+            return None
+        if issued is not None:
+            with issued_lock:
+                if next(issued, None) is None:
+                    return None
+        return random.choices(ops, weights)[0]
+
+    def user_loop() -> None:
+        user = VirtualUser(base, auth, recorder, stop, jobs, args.timeout,
+                           args.job_timeout, args.poll_interval)
+        while (op := next_op()) is not None:
+            user.run(op)
+
+    threads = [threading.Thread(target=user_loop, name=f'user-{i}',
+                                daemon=True)
+               for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    # Samples during the warm-up are discarded
+    time.sleep(args.warmup)
+    recorder.enabled = True
+    start = time.monotonic()
+
+    if args.requests:
+        for thread in threads:
+            thread.join()
+    else:
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join(args.timeout)
+    elapsed = time.monotonic() - start
+    recorder.enabled = False
+    stop.set()
+
+    return {'elapsed_s': round(elapsed, 3), **recorder.summary(elapsed)}
+
+
+def server_stats(base: str, auth: tuple[str, str]) -> dict | None:
+    try:
+        response = requests.get(f'{base}/stats', auth=auth, timeout=5)
+        return response.json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def main(args: argparse.Namespace) -> None:
+    with open(os.path.join(SRC_DIR, 'weights.json'), 'r') as f:
+        jobs = list(json.load(f)['jobs'])
+
+    stubs = server = None
+    try:
+        if args.url:
+            base = args.url.rstrip('/')
+        else:
+            stubs = StubUpstreams(args.upstream_latency, args.upstream_jitter,
+                                  args.upstream_fail_rate,
+                                  args.image_size * 1024)
+            stubs.start()
+            server = ServerProcess(shlex.split(args.server_args), stubs.env(),
+                                   args.keep_dir)
+            server.wait_ready()
+            base = server.base
+
+        results = run_load(args, base, jobs)
+        report = {
+            'config': {
+                'url': args.url,
+                'server_args': args.server_args,
+                'concurrency': args.concurrency,
+                'duration_s': None if args.requests else args.duration,
+                'requests': args.requests or None,
+                'warmup_s': args.warmup,
+                'mix': args.mix,
+                'upstream': None if args.url else {
+                    'latency_ms': args.upstream_latency,
+                    'jitter_ms': args.upstream_jitter,
+                    'fail_rate': args.upstream_fail_rate,
+                },
+            },
+            **results,
+            'upstream_requests': dict(stubs.counts) if stubs else None,
+            'server_stats': server_stats(base, (args.user, args.password)),
+        }
+    finally:
+        if server is not None:
+            server.stop()
+            if args.keep_dir:
+                print(f'Server files kept in {server.workdir}',
+                      file=sys.stderr)
+        if stubs is not None:
+            stubs.close()
+
+    output = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+    total = report['total']
+    print(f"{total['count']} requests in {report['elapsed_s']}s: "
+          f"{total['rps']} req/s, p99 {total['latency_ms']['p99']} ms, "
+          f"{100 * total['error_rate']:.2f}% errors", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESC)
+    parser.add_argument('-c', '--concurrency', type=int, default=8,
+                        help='virtual users (default 8)')
+    parser.add_argument('-d', '--duration', type=float, default=20,
+                        help='seconds to measure for (default 20)')
+    parser.add_argument('-n', '--requests', type=int, default=0,
+                        help='stop after this many operations instead of '
+                             'after --duration')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds of load before measuring (default 2)')
+    parser.add_argument('-m', '--mix', type=parse_mix,
+                        default=parse_mix(DEFAULT_MIX),
+                        help='weights of the operations, from '
+                             f'{", ".join(OPS)} (default {DEFAULT_MIX})')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file for the JSON report (default stdout)')
+    parser.add_argument('--server-args', default='--sessions --storage sqlite',
+                        help='arguments for server.py (default `--sessions '
+                             '--storage sqlite`, so each virtual user has its '
+                             'own form)')
+    parser.add_argument('--url',
+                        help='load test a server already running at this URL '
+                             'instead (it is not given the stub upstreams)')
+    parser.add_argument('--user', default='20005743',
+                        help='Basic authentication user')
+    parser.add_argument('--password', default='20005743',
+                        help='Basic authentication password')
+    parser.add_argument('--upstream-latency', type=float, default=0,
+                        help='milliseconds added to each stub upstream '
+                             'response (default 0)')
+    parser.add_argument('--upstream-jitter', type=float, default=0,
+                        help='up to this many more milliseconds, at random '
+                             '(default 0)')
+    parser.add_argument('--upstream-fail-rate', type=float, default=0,
+                        help='fraction of stub upstream responses that are '
+                             '503s (default 0)')
+    parser.add_argument('--image-size', type=int, default=16,
+                        help='size of the stub images in KiB (default 16)')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds before a request counts as failed '
+                             '(default 30)')
+    parser.add_argument('--job-timeout', type=float, default=60,
+                        help='seconds to wait for an analysis job (default 60)')
+    parser.add_argument('--poll-interval', type=float, default=0.05,
+                        help='seconds between polls of an analysis job '
+                             '(default 0.05)')
+    parser.add_argument('--keep-dir', action='store_true', default=False,
+                        help="keep the server's working directory and log")
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,373 @@
+"""
+Micro-benchmarks of the request hot paths: scoring (PsychProfiler.analyse,
+normalise_scores and ScoringEngine, per call and in batch), building JSON
+responses with send_response, loading static content with
+load_and_check_content, and Authenticator.authenticate. Everything runs in
+process against src/, with no network access.
+
+Each benchmark reports the median and minimum time per call over several
+repeats, and the peak memory allocated by a call (from tracemalloc). Results
+can be saved as a named baseline, and a later run compared against it: any
+benchmark slower (or allocating more) than the baseline by more than the
+threshold is flagged as a regression, and the exit status is 1.
+
+Run from the repository root, e.g.
+    python bench/microbench.py --save before
+    python bench/microbench.py --compare before --threshold 0.1
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import timeit
+import random
+import shutil
+import base64
+import argparse
+import platform
+import tempfile
+import itertools
+import statistics
+import tracemalloc
+from http.server import BaseHTTPRequestHandler
+from http.client import HTTPMessage
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.normpath(os.path.join(BENCH_DIR, os.pardir, 'src'))
+BASELINE_DIR = os.path.join(BENCH_DIR, 'baselines')
+
+# Relative paths given on the command line are resolved against the
+# directory the script was run from, not src/ (the web root)
+INVOCATION_DIR = os.getcwd()
+
+# The modules under test expect to run from src/, like server.py
+sys.path.insert(0, SRC_DIR)
+os.chdir(SRC_DIR)
+
+import numpy as np
+
+from analysis import PsychProfiler
+from authentication import Authenticator
+from response_utils import send_response, load_and_check_content
+from scoring import shared_engine, TRAIT_MAP
+
+
+DESC = "Micro-benchmarks of scoring, responses and authentication."
+
+N_QUESTIONS = sum(len(qs) for qs in TRAIT_MAP.values())
+CREDENTIALS = b'20005743:20005743'
+
+# Answer patterns of the generated forms, each used with every job
+PATTERNS = ('neutral', 'low', 'high', 'alternating', 'random', 'shuffled',
+            'partial')
+
+# Static content of each kind served by the app
+CONTENT = {
+    'html': ('index.html', 'text/html', 'r'),
+    'js': ('main.js', 'text/javascript', 'r'),
+    'json': ('default_input.json', 'application/json', 'r'),
+    'png': ('logo.png', 'image/png', 'rb'),
+}
+
+
+def make_form(job: str, pattern: str, rng: random.Random) -> dict:
+    # A form with the answers of `pattern`, in the order of the website
+    # unless shuffled, and missing some questions if partial (but still
+    # answering a question of each trait, or it can't be scored)
+    qs = list(range(1, N_QUESTIONS + 1))
+    answers = {
+        'neutral': lambda q: 3,
+        'low': lambda q: 1,
+        'high': lambda q: 5,
+        'alternating': lambda q: 1 if q % 2 else 5,
+    }.get(pattern, lambda q: rng.randint(1, 5))
+
+    if pattern == 'shuffled':
+        rng.shuffle(qs)
+    elif pattern == 'partial':
+        qs = sorted(q for trait_qs in TRAIT_MAP.values()
+                    for q in rng.sample(trait_qs,
+                                        rng.randint(1, len(trait_qs))))
+
+    form = {'pets': [], 'name': 'Bench'}
+    form.update({f'question{q}': str(answers(q)) for q in qs})
+    form['job'] = job
+    return form
+
+
+def make_forms(n: int, seed: int) -> list[dict]:
+    # `n` forms cycling through every job and answer pattern
+    rng = random.Random(seed)
+    jobs = shared_engine.get().jobs
+    combos = [(job, pattern) for job in jobs for pattern in PATTERNS]
+    return [make_form(*combos[i % len(combos)], rng) for i in range(n)]
+
+
+class BenchHandler(BaseHTTPRequestHandler):
+    """ Request handler writing its response to memory instead of a socket """
+
+    def __init__(self, headers: dict[str, str] | None = None):
+        self.wfile = io.BytesIO()
+        self.client_address = ('127.0.0.1', 0)
+        self.request_version = 'HTTP/1.1'
+        self.requestline = 'GET / HTTP/1.1'
+        self.command = 'GET'
+        self.path = '/'
+        self.close_connection = False
+        self.headers = HTTPMessage()
+        for k, v in (headers or {}).items():
+            self.headers[k] = v
+
+    def reset(self) -> None:
+        self.wfile.seek(0)
+        self.wfile.truncate()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+def scoring_benchmarks(forms: list[dict], batch_size: int) -> dict:
+    engine = shared_engine.get()
+    next_form = itertools.cycle(forms).__next__
+    rng = random.Random(0)
+    raw = [([rng.uniform(-4, 4) for _ in range(N_QUESTIONS)],
+            rng.uniform(-40, -20), rng.uniform(20, 40)) for _ in range(64)]
+    next_raw = itertools.cycle(raw).__next__
+    profiler = PsychProfiler(forms[0])
+    batches = [forms[i:i + batch_size]
+               for i in range(0, len(forms) - batch_size + 1, batch_size)]
+    next_batch = itertools.cycle(batches or [forms[:batch_size]]).__next__
+
+    return {
+        'scoring.analyse': lambda: PsychProfiler(next_form()).analyse(),
+        'scoring.normalise_scores':
+            lambda: profiler.normalise_scores(*next_raw()),
+        'scoring.engine_score': lambda: engine.score(next_form()),
+        # Timed per batch; see `per` below
+        'scoring.score_batch': lambda: engine.score_batch(next_batch()),
+    }
+
+
+def response_benchmarks(forms: list[dict]) -> dict:
+    handler = BenchHandler()
+    profile = PsychProfiler(forms[0]).analyse()
+
+    def send(status: int, **kwargs):
+        handler.reset()
+        send_response(handler, status, **kwargs)
+
+    return {
+        'response.send_200_data':
+            lambda: send(200, message='Profile', data=profile),
+        'response.send_400': lambda: send(400, message='Bad request'),
+        'response.send_404': lambda: send(404, path='/missing'),
+    }
+
+
+def content_benchmarks() -> dict:
+    handler = BenchHandler()
+    return {
+        f'content.load_{kind}':
+            (lambda args=args: load_and_check_content(handler, *args))
+        for kind, args in CONTENT.items()
+    }
+
+
+def auth_benchmarks(workdir: str) -> dict:
+    # On a copy of auth.json, since failed attempts are written back
+    auth_file = os.path.join(workdir, 'auth.json')
+    shutil.copy('auth.json', auth_file)
+    authenticator = Authenticator(ban=False, auth_file=auth_file)
+
+    def auth_headers(credentials: bytes) -> HTTPMessage:
+        headers = HTTPMessage()
+        headers['Authorization'] = ('Basic ' +
+                                    base64.b64encode(credentials).decode())
+        return headers
+
+    good = auth_headers(CREDENTIALS)
+    bad = auth_headers(b'20005743:wrong')
+    handler = BenchHandler({'Authorization': good['Authorization']})
+
+    return {
+        'auth.authenticate_ok': lambda: authenticator.authenticate(good),
+        'auth.authenticate_bad': lambda: authenticator.authenticate(bad),
+        'auth.handle_auth': lambda: authenticator.handle_auth(handler),
+    }
+
+
+def time_per_call(fn, repeat: int, min_time: float) -> list[float]:
+    # Seconds per call in each repeat, with enough calls per repeat to
+    # take at least `min_time`
+    timer = timeit.Timer(fn)
+    number, taken = timer.autorange()
+    number = max(1, round(number * min_time / taken))
+    return [t / number for t in timer.repeat(repeat, number)]
+
+
+def peak_alloc(fn, calls: int) -> tuple[int, int]:
+    # Peak bytes allocated during a call (the max over `calls`), and the
+    # bytes per call still allocated afterwards
+    fn()  # Allow any lazy set-up before measuring
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        peak = 0
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            fn()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+        retained = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+    return peak, retained // calls
+
+
+def run(benchmarks: dict, args: argparse.Namespace) -> dict:
+    results = {}
+    for name, fn in benchmarks.items():
+        per = args.batch_size if name == 'scoring.score_batch' else 1
+        times = time_per_call(fn, args.repeat, args.min_time)
+        peak, retained = peak_alloc(fn, args.alloc_calls)
+        results[name] = {
+            'median_us': round(1e6 * statistics.median(times) / per, 4),
+            'min_us': round(1e6 * min(times) / per, 4),
+            'stdev_us': round(1e6 * statistics.stdev(times) / per, 4)
+                        if len(times) > 1 else 0.0,
+            'peak_bytes': peak // per,
+            'retained_bytes': retained // per,
+        }
+        print(f"{name:32} {results[name]['median_us']:>12.3f} us "
+              f"{results[name]['peak_bytes']:>10} B", file=sys.stderr)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> dict:
+    # Ratio of each result to the baseline, flagging regressions past
+    # the threshold. Allocations are only compared if large enough to be
+    # stable
+    comparison = {}
+    for name, result in results.items():
+        if (base := baseline['results'].get(name)) is None:
+            continue
+        time_ratio = result['median_us'] / base['median_us']
+        alloc_ratio = (result['peak_bytes'] / base['peak_bytes']
+                       if base['peak_bytes'] >= 1024 else 1.0)
+        comparison[name] = {
+            'time_ratio': round(time_ratio, 4),
+            'alloc_ratio': round(alloc_ratio, 4),
+            'regression': (time_ratio > 1 + threshold or
+                           alloc_ratio > 1 + threshold),
+        }
+    return comparison
+
+
+def user_path(path: str) -> str:
+    return os.path.join(INVOCATION_DIR, path)
+
+
+def baseline_path(name: str) -> str:
+    return user_path(name) if name.endswith('.json') else os.path.join(
+        BASELINE_DIR, f'{name}.json'
+    )
+
+
+def main(args: argparse.Namespace) -> int:
+    forms = make_forms(args.forms, args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        benchmarks = {
+            **scoring_benchmarks(forms, args.batch_size),
+            **response_benchmarks(forms),
+            **content_benchmarks(),
+            **auth_benchmarks(workdir),
+        }
+        if args.filter:
+            benchmarks = {k: v for k, v in benchmarks.items()
+                          if any(f in k for f in args.filter)}
+        if args.list:
+            print('\n'.join(benchmarks))
+            return 0
+
+        report = {
+            'meta': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'seed': args.seed,
+                'forms': args.forms,
+                'batch_size': args.batch_size,
+            },
+            'results': run(benchmarks, args),
+        }
+
+    status = 0
+    if args.compare:
+        with open(baseline_path(args.compare), 'r') as f:
+            baseline = json.load(f)
+        report['compare'] = {
+            'baseline': args.compare,
+            'threshold': args.threshold,
+            'results': compare(report['results'], baseline, args.threshold),
+        }
+        regressions = [name for name, c in report['compare']['results'].items()
+                       if c['regression']]
+        for name in regressions:
+            c = report['compare']['results'][name]
+            print(f"Regression: {name} time x{c['time_ratio']}, "
+                  f"allocations x{c['alloc_ratio']}", file=sys.stderr)
+        status = 1 if regressions else 0
+
+    if args.save:
+        path = baseline_path(args.save)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved baseline {path}', file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output == '-':
+        print(output)
+    else:
+        with open(user_path(args.output), 'w') as f:
+            f.write(output + '\n')
+
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESC)
+    parser.add_argument('-k', '--filter', action='append',
+                        help='only run benchmarks whose name contains this '
+                             '(repeatable)')
+    parser.add_argument('--list', action='store_true', default=False,
+                        help='list the benchmarks and exit')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='timed repeats of each benchmark (default 5)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds per repeat (default 0.2)')
+    parser.add_argument('--alloc-calls', type=int, default=200,
+                        help='calls traced for allocations (default 200)')
+    parser.add_argument('--forms', type=int, default=1024,
+                        help='randomised forms to score (default 1024)')
+    parser.add_argument('--batch-size', type=int, default=256,
+                        help='forms per score_batch call (default 256)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the randomised forms (default 0)')
+    parser.add_argument('--save', metavar='NAME',
+                        help='save the results as a baseline, in '
+                             'bench/baselines/NAME.json (or a .json path)')
+    parser.add_argument('--compare', metavar='NAME',
+                        help='compare against a saved baseline; exits with 1 '
+                             'if any benchmark regressed')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='fractional slowdown (or growth in allocations) '
+                             'that counts as a regression (default 0.1)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='file for the JSON report (default stdout)')
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -4,14 +4,33 @@ methodologies used. Any ValueError is caught by do_analyse and sends a 500 respo
 """
 
 import os
-import glob
-import json
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 
 from response_utils import send_response
-from fetch_utils import fetch_data, check_img, download_img
+from cache_utils import MovieCache
+from fetch_utils import fetch_data, check_img, download_img, clear_images
+from metrics import ANALYSIS_PHASES
+from profiling import span, propagate
+from scoring import ScoringEngine, shared_engine
+from storage import Storage, JSONStorage, DEFAULT_USER
 
 os.environ["OMDb_API_KEY"] = "2c9b7593"
 
+# Seconds allowed for fetching the movie data, posters and pet images of
+# one analysis. Anything still missing after this is left out of the profile
+ANALYSIS_DEADLINE = 20.0
+
+# Pets supported by DataFetcher, and how many times to ask an API for an
+# image of a supported type
+PETS = ('dog', 'cat', 'duck')
+MAX_PET_ATTEMPTS = 5
+
+# Upstream requests of all analyses share these threads
+FETCH_POOL = ThreadPoolExecutor(max_workers=16, thread_name_prefix='fetch')
+
 
 class PsychProfiler:
     """ Psychological evaluation class """
@@ -21,34 +40,28 @@ class PsychProfiler:
         self.setup()
 
     def setup(self) -> None:
-        with open('weights.json', 'r') as f:
-            weights = json.load(f)
+        # The weights are compiled once per process and shared (see
+        # scoring.py), so they are never modified here
+        engine = shared_engine.get()
+        if engine.max_score != self.max_score:
+            engine = ScoringEngine(engine.weights, self.max_score)
 
         # Contains the job weights (see report) and a relevant
         # film (title, year)
-        self.job_dict = weights['jobs']
+        self.job_dict = engine.job_dict
         self.set_job(self.form_input['job'])
 
         # Derived from the MOVIE framework (Monteiro and Pimentel, 2023)
         # For films, I use the example from the study for the most
         # correlated genre within a preference category
-        self.movie_dict = weights['movies']
-
-        # Each question is mapped to one of the Big Five traits
-        trait_map_temp = {
-            'O':[3,7,11],
-            'C':[2,5,10,12,15],
-            'E':[1,8,14,16,20],
-            'A':[4,9,17,18],
-            'N':[6,13,19]
-        }
-        self.trait_map = {}
-        for k, vs in trait_map_temp.items():
-            for v in vs:
-                self.trait_map[v] = k
+        self.movie_dict = engine.movie_dict
 
-        # Account for reversed questions
-        self.reversed_qns = [5,6,9,12,14,16,17,18]
+        # Each question is mapped to one of the Big Five traits,
+        # and some questions are reversed (see scoring.py). The
+        # weights are compiled into matrices for scoring
+        self.engine = engine
+        self.trait_map = self.engine.trait_map
+        self.reversed_qns = self.engine.reversed_qns
 
     def normalise_scores(self,
                          scores: list[float],
@@ -69,69 +82,13 @@ class PsychProfiler:
         # movie recommendation. Returns a dict which also includes
         # the career-based movie recommendation
 
-        weighted_job_scores = []
-        weighted_movie_scores = { k : {'scores': [], 'min': []}
-                                  for k in self.movie_dict.keys() }
-
-        min_job_scores = []
-
-        for k, v in self.form_input.items():
-            if k.startswith('question'):
-                q, a = int(k[len('question'):]), int(v)
-
-                if q in self.reversed_qns:
-                    a = 6 - a  # Reverse Likert scale value
-
-                a-=3  # Shift to range [-2,...,2]
-
-                # Apply weight
-                trait = self.trait_map[q]
-                w = self.job_info['weights'][trait]
-                weighted_job_scores.append(a * w)
-
-                # Worst-case: 5 for -ve weight, 1 for +ve weight
-                min_job_scores.append(w * 2 if w < 0 else w * -2)
-                
-                # Apply weight for actual & worst for each psych movie
-                for k_, v_ in self.movie_dict.items():
-                    w_ = v_['weights'][trait]
-                    weighted_movie_scores[k_]['scores'].append(a * w_)
-                    weighted_movie_scores[k_]['min'].append(
-                        w_ * 2 if w_ < 0 else w_ * -2)
-
-        total_min = sum(min_job_scores)
-        total_max = -total_min  # since response range is {-2,...,2}
-        self.job_score = self.normalise_scores(
-            weighted_job_scores, total_min, total_max)
-
-        # All neutral responses -> every film gets max_score/2
-        # Hence, set a default: LotR ('I')
-        self.psych_movie = self.movie_dict['I']
-
-        # Find the most suitable psych movie
-        # Need the score - similar to above - for each
-        movie_score = self.max_score / 2
-        for k, s in weighted_movie_scores.items():
-            total_min = sum(s['min'])
-            total_max = -total_min
-            s = self.normalise_scores(
-                s['scores'], total_min, total_max)
-            if s > movie_score:
-                movie_score = s
-                self.psych_movie = self.movie_dict[k]
-        self.psych_movie['suitability'] = movie_score
-
-        return {
-            'career': {
-                'desired': self.job,
-                'suitability': self.job_score,
-            },
-            'movies': {
-                'job': self.job_info['movie'],
-                'psych': self.psych_movie,
-            },
-            'max_score': self.max_score,
-        }
+        # All jobs and movies are scored at once by the engine
+        with span('scoring'):
+            profile = self.engine.score(self.form_input)
+        self.job_score = profile['career']['suitability']
+        self.psych_movie = profile['movies']['psych']
+
+        return profile
 
     def set_job(self, job: str) -> None:
         jobs = ['ceo', 'astronaut', 'doctor', 'model', 'rockstar', 'garbage']
@@ -149,26 +106,38 @@ class DataFetcher:
         third party sites via their RESTful API
     """
 
-    def __init__(self):
+    def __init__(self,
+                 movie_cache: MovieCache | None = None,
+                 pet_prefetcher: 'PetPrefetcher | None' = None):
+        self.movie_cache = movie_cache
+        self.pet_prefetcher = pet_prefetcher
         omdb_key = os.environ.get("OMDb_API_KEY")
+        # Each API can be pointed elsewhere, e.g. at the local stand-ins
+        # used for load testing (see bench/loadtest.py)
+        env = os.environ.get
         self.apis = {
-            'dog': 'https://dog.ceo/api/breeds/image/random',
-            'cat': 'https://api.thecatapi.com/v1/images/search',
-            'duck': 'https://random-d.uk/api/v2/random',
-            'movie': f'http://www.omdbapi.com/?apikey={omdb_key}'
+            'dog': env('PSYCH_DOG_API',
+                       'https://dog.ceo/api/breeds/image/random'),
+            'cat': env('PSYCH_CAT_API',
+                       'https://api.thecatapi.com/v1/images/search'),
+            'duck': env('PSYCH_DUCK_API', 'https://random-d.uk/api/v2/random'),
+            'movie': (f"{env('PSYCH_OMDB_API', 'http://www.omdbapi.com/')}"
+                      f'?apikey={omdb_key}')
         }
 
-    def fetch_pet_img_ref(self, pet: str) -> str:
+    def fetch_pet_img_ref(self,
+                          pet: str,
+                          max_attempts: int = MAX_PET_ATTEMPTS) -> str:
         # Fetch pet image metadata
 
-        if pet not in ['dog', 'cat', 'duck']:
+        if pet not in PETS:
             raise ValueError('pet must be `dog`, `cat` or `duck`')
         
         uri = self.apis[pet]
 
         # Ensure image is JPG/JPEG/GIF/PNG
         valid = False
-        while not valid:
+        for _ in range(max_attempts):
             response = fetch_data(uri)
 
             # Action each of the URLs referenced in the first response
@@ -176,7 +145,12 @@ class DataFetcher:
             # Some APIs use 'url', while others use 'message'
             response = response[0] if isinstance(response, list) else response
             img_url = response.get('url', response.get('message'))
-            valid = check_img(img_url)
+            if (valid := check_img(img_url)):
+                break
+
+        if not valid:
+            raise ValueError(f'No supported {pet} image in {max_attempts} '
+                             'attempts')
 
         return img_url
 
@@ -186,26 +160,69 @@ class DataFetcher:
         # Fetch the movie data from OMDb. Search includes both
         # title and year as this ensures that the film is correct.
         # Returns a dictionary derived from the JSON response.
+        # With a movie cache, cached data (and poster) is used while
+        # fresh, and when stale only if OMDb can't be reached
+
+        cache = self.movie_cache
+        movie_data = cache.get(movie_info) if cache is not None else None
+        if movie_data is None:
+            movie_data = self.refresh_movie_data(movie_info)
+
+        if download_posters and movie_data['local_poster'] is None:
+            movie_data['local_poster'] = self.download_poster(movie_info,
+                                                              movie_data)
+
+        return movie_data
+
+    def refresh_movie_data(self, movie_info: dict[str]) -> dict[str]:
+        # Query OMDb, updating the movie cache (if any)
+        cache = self.movie_cache
+        old = cache.get(movie_info, stale=True) if cache is not None else None
+
+        try:
+            movie_data = self.query_omdb(movie_info)
+        except Exception:
+            if old is None:
+                raise
+            print(f"Using stale movie data for `{movie_info['title']}`")
+            return old
+
+        # Keep a poster already downloaded from the same URL
+        movie_data['local_poster'] = (
+            old['local_poster']
+            if old is not None and old.get('Poster') == movie_data.get('Poster')
+            else None
+        )
+        if cache is not None:
+            cache.put(movie_info, movie_data)
+
+        return movie_data
 
+    def query_omdb(self, movie_info: dict[str]) -> dict[str]:
         t = movie_info['title'].replace(' ', '+')
         y = movie_info['year']
         uri = f"{self.apis['movie']}&t={t}&y={y}"
         movie_data = fetch_data(uri)
-        movie_data.pop('Response')
-        movie_data['local_poster'] = (
-            download_img(movie_data['Poster']) if download_posters
-            else None
-        )
+        if movie_data.pop('Response') != 'True':
+            # e.g. {"Response": "False", "Error": "Movie not found!"}
+            raise ValueError(f"OMDb: {movie_data.get('Error')}")
 
         return movie_data
 
+    def download_poster(self,
+                        movie_info: dict[str],
+                        movie_data: dict[str]) -> str:
+        local_poster = download_img(movie_data['Poster'])
+        if self.movie_cache is not None:
+            self.movie_cache.set_poster(movie_info, local_poster)
+
+        return local_poster
+
     def clear_images(self):
         # Helper method to delete local images. Not used in the final
-        # version since images were not removed in the tutorial demo
-        for fp in glob.glob(f'images/*'):
-            if os.path.isfile(fp):
-                print(f'Removing {fp}') 
-                os.remove(fp)
+        # version since images were not removed in the tutorial demo.
+        # The image store now caps its size itself
+        clear_images()
 
     def download_pet_images(self, pets: str | list) -> dict[str]:
         # Downloads images for each pet and returns the local references
@@ -215,54 +232,259 @@ class DataFetcher:
 
         local_uris = {}
         for pet in pets:
-            url = self.fetch_pet_img_ref(pet)
-            local_uris[pet] = download_img(url)
+            local_uris[pet] = self.download_pet_image(pet)
 
         return local_uris
 
+    def download_pet_image(self, pet: str) -> str:
+        # Use a prefetched image if one is ready
+        if (self.pet_prefetcher is not None and
+                (local_uri := self.pet_prefetcher.pop(pet)) is not None):
+            return local_uri
+
+        return download_img(self.fetch_pet_img_ref(pet))
 
-def analyse(input_path: str = os.path.join('data', 'input.json'),
-            quiet: bool = True) -> dict:
+
+class PetPrefetcher:
+    """
+        Keeps up to `depth` downloaded images ready for each pet, refilled
+        by a background thread per pet. Failed fetches are retried after an
+        exponential backoff of at most `max_backoff` seconds
+    """
+
+    def __init__(self, depth: int = 3, max_backoff: float = 60.0):
+        self.depth = depth
+        self.max_backoff = max_backoff
+        self.data_fetcher = DataFetcher()
+        self.ready = {pet: queue.Queue(maxsize=depth) for pet in PETS}
+        self.stopped = threading.Event()
+
+        self.threads = [
+            threading.Thread(target=self.refill, args=(pet,),
+                             name=f'prefetch-{pet}', daemon=True)
+            for pet in PETS
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def refill(self, pet: str) -> None:
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                local_uri = self.data_fetcher.download_pet_image(pet)
+            except Exception as e:
+                failures += 1
+                backoff = min(self.max_backoff, 2 ** failures)
+                print(f'Failed to prefetch {pet} image: {e!r}. '
+                      f'Retrying in {backoff}s')
+                self.stopped.wait(backoff)
+                continue
+
+            failures = 0
+            # Blocks while the queue is full
+            while not self.stopped.is_set():
+                try:
+                    self.ready[pet].put(local_uri, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def pop(self, pet: str) -> str | None:
+        # Returns a ready image, or None if there is none
+        while True:
+            try:
+                local_uri = self.ready[pet].get_nowait()
+            except (KeyError, queue.Empty):
+                return None
+            # May have been evicted from the image store since
+            if os.path.isfile(local_uri):
+                return local_uri
+
+    def stats(self) -> dict:
+        return {pet: q.qsize() for pet, q in self.ready.items()}
+
+    def close(self) -> None:
+        self.stopped.set()
+
+
+def analyse(form_input: dict | None = None,
+            storage: Storage | None = None,
+            user: str = DEFAULT_USER,
+            quiet: bool = True,
+            deadline: float = ANALYSIS_DEADLINE,
+            data_fetcher: DataFetcher | None = None) -> dict:
     # This function utilises PsychProfiler and DataFetcher to
-    # form a profile to the assignment specifications
+    # form a profile to the assignment specifications. The form
+    # must have been claimed for analysis via `storage`; if no
+    # `form_input` is given, it is claimed here
+
+    storage = storage or JSONStorage()
 
-    if not os.path.exists(input_path):
-        raise ValueError(f'Missing {input_path}')
+    if form_input is None:
+        state, form_input = storage.claim_analysis(user)
+        if form_input is None:
+            raise ValueError(f'No form to analyse (state: {state})')
 
-    with open(input_path, 'r') as f:
-        form_input = json.load(f)
+    try:
+        profile = create_profile(form_input, deadline, data_fetcher)
+    except BaseException:
+        storage.release_analysis(user)
+        raise
 
-    profiler = PsychProfiler(form_input)
-    data_fetcher = DataFetcher()
+    # Save the serialised profile, unless the form was resubmitted
+    with ANALYSIS_PHASES.time('save'):
+        saved = storage.save_profile(user, form_input, profile)
+    if not saved:
+        print('Form was resubmitted during analysis. Discarding profile')
+
+    if not quiet:
+        print('Generated profile:', profile)
+
+    return profile
+
+
+def warm_movie_cache(data_fetcher: DataFetcher) -> None:
+    # Fetch every movie referenced in weights.json, and its poster, unless
+    # already cached. Run at startup so analyses find them in the cache
+    engine = shared_engine.get()
+    movies = ([job['movie'] for job in engine.job_dict.values()]
+              + list(engine.movie_dict.values()))
+
+    futures = {
+        FETCH_POOL.submit(data_fetcher.fetch_movie_data, movie): movie
+        for movie in movies
+    }
+
+    n_ready = 0
+    for future, movie in futures.items():
+        try:
+            future.result()
+            n_ready += 1
+        except Exception as e:
+            print(f"Failed to warm movie cache for `{movie['title']}`: {e!r}")
+
+    print(f'Movie cache: {n_ready}/{len(movies)} movies ready.')
+
+
+def remaining(expires: float) -> float:
+    return max(0, expires - time.monotonic())
+
+
+def fetch_result(future: Future, expires: float, what: str):
+    # The result of a fetch, or None if it failed or missed the deadline
+    try:
+        return future.result(timeout=remaining(expires))
+    except TimeoutError:
+        future.cancel()
+        print(f'Analysis deadline passed before fetching {what}')
+    except Exception as e:
+        print(f'Failed to fetch {what}: {e!r}')
+    return None
+
+
+def fallback_movie_data(movie_info: dict[str]) -> dict[str]:
+    # Stand-in for OMDb data, using 'N/A' for unknown fields as OMDb does
+    return {
+        'Title': movie_info['title'].title(),
+        'Year': movie_info['year'],
+        'Rated': 'N/A',
+        'Plot': 'N/A',
+        'Poster': 'N/A',
+        'local_poster': None,
+    }
+
+
+def timed(phase: str, fn):
+    # Wrap `fn` to record its duration as a phase of the analysis
+    def run(*args):
+        with ANALYSIS_PHASES.time(phase):
+            return fn(*args)
+    return run
+
+
+def create_profile(form_input: dict,
+                   deadline: float = ANALYSIS_DEADLINE,
+                   data_fetcher: DataFetcher | None = None) -> dict:
+    data_fetcher = data_fetcher or DataFetcher()
 
     # Create the psychological profile
-    profile = profiler.analyse()
+    with ANALYSIS_PHASES.time('scoring'):
+        profiler = PsychProfiler(form_input)
+        profile = profiler.analyse()
+    fetch_start = time.perf_counter()
+
+    # Fetch movie data for job & psych recommendations and the pet images
+    # concurrently, so the analysis takes as long as the slowest upstream.
+    # Pieces that fail or miss the deadline are listed in `missing`
+    expires = time.monotonic() + deadline
+    missing = []
+
+    movie_futures = {
+        FETCH_POOL.submit(
+            propagate(timed('movie_fetch', data_fetcher.fetch_movie_data)),
+            v, False
+        ): k
+        for k, v in profile['movies'].items()
+    }
+
+    pets = form_input['pets']
+    pets = [pets] if isinstance(pets, str) else pets
+    pet_futures = {
+        pet: FETCH_POOL.submit(
+            propagate(timed('pet_fetch', data_fetcher.download_pet_image)),
+            pet
+        )
+        for pet in pets
+    }
+
+    # Download each poster (unless cached) as soon as its movie data arrives
+    poster_futures = {}
+    try:
+        for future in as_completed(movie_futures, timeout=remaining(expires)):
+            if future.exception() is not None:
+                continue
+            k, movie_data = movie_futures[future], future.result()
+            if (movie_data['local_poster'] is None and
+                    movie_data.get('Poster', 'N/A') != 'N/A'):
+                poster_futures[k] = FETCH_POOL.submit(
+                    propagate(timed('poster_download',
+                                    data_fetcher.download_poster)),
+                    profile['movies'][k], movie_data
+                )
+    except TimeoutError:
+        pass
 
-    # Fetch movie data for job & psych recommendations
     movie_suitability = profile['movies']['psych']['suitability']
-    for k, v in profile['movies'].items():
-        profile['movies'][k] = data_fetcher.fetch_movie_data(v)
+    for future, k in movie_futures.items():
+        movie_info = profile['movies'][k]
+        movie_data = fetch_result(future, expires,
+                                  f"{k} movie `{movie_info['title']}`")
+        if movie_data is None:
+            missing.append(f'movies.{k}')
+            profile['movies'][k] = fallback_movie_data(movie_info)
+            continue
+
+        if k in poster_futures:
+            movie_data['local_poster'] = fetch_result(
+                poster_futures[k], expires, f'{k} movie poster'
+            )
+        if movie_data['local_poster'] is None:
+            missing.append(f'movies.{k}.poster')
+        profile['movies'][k] = movie_data
     profile['movies']['psych']['suitability'] = movie_suitability
 
-    # Fetch pet images
-    profile['pets'] = data_fetcher.download_pet_images(form_input['pets'])
-
-    # Copy name for greeting
-    profile['name'] = form_input['name'].title()
+    profile['pets'] = {}
+    for pet, future in pet_futures.items():
+        profile['pets'][pet] = fetch_result(future, expires, f'{pet} image')
+        if profile['pets'][pet] is None:
+            missing.append(f'pets.{pet}')
 
-    # Add a tag to avoid re-analysing
-    form_input['analysed'] = True
+    profile['missing'] = missing
 
-    # Save the serialised profile
-    input_path = os.path.join('data', 'input.json')
-    profile_path = os.path.join('data', 'profile.json')
-    with open(input_path, 'w') as f:
-        json.dump(form_input, f)
-    with open(profile_path, 'w') as f:
-        json.dump(profile, f)
+    # Wall time of all the fetches, including waiting on the deadline
+    ANALYSIS_PHASES.observe(time.perf_counter() - fetch_start, 'fetch')
 
-    if not quiet:
-        print('Generated profile:', profile)
+    # Copy name for greeting
+    profile['name'] = form_input['name'].title()
 
     return profile
-
@@ -0,0 +1,207 @@
+"""
+Serves the website on an asyncio event loop rather than a thread per
+connection. Requests are read by the loop and then handled by the same
+request handler as the threaded server, so routes, authentication and
+responses are identical. Idle keep-alive connections cost a coroutine rather
+than an OS thread, while POST requests (which may block on upstream APIs
+during analysis) run on a bounded thread pool. Files sent from disk are
+streamed by the loop with loop.sendfile after the buffered response head.
+"""
+
+import io
+import os
+import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Largest request head/body accepted, in bytes
+MAX_HEAD_SIZE = 64 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+TOO_LARGE = (b'HTTP/1.1 413 Content Too Large\r\n'
+             b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+
+class BufferedHandlerMixin:
+    """
+        Runs a BaseHTTPRequestHandler on a single request that was already
+        read into memory, collecting the response in `wfile`, and any file
+        part to send after it in `file_part`
+    """
+
+    def __init__(self, request: bytes, client_address, server,
+                 n_served: int = 0, **kwargs):
+        self.n_served = n_served
+        super().__init__(request, client_address, server, **kwargs)
+
+    def setup(self) -> None:
+        self.rfile = io.BytesIO(self.request)
+        self.wfile = io.BytesIO()
+        self.file_part = None
+
+    def handle(self) -> None:
+        # Count requests over the whole connection for `max_requests`
+        self.n_requests = self.n_served
+        self.handle_one_request()
+
+    def write_file(self, f, offset: int, count: int) -> int:
+        # Left to the connection's coroutine, which sends the file with
+        # loop.sendfile rather than reading it into memory here. `f` is
+        # closed on return, so a duplicate is kept open for it
+        self.file_part = (os.fdopen(os.dup(f.fileno()), 'rb'), offset, count)
+        return count
+
+    def finish(self) -> None:
+        pass
+
+
+def content_length(head: bytes) -> int:
+    # Extract the Content-Length from the raw request head
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            return int(value.strip())
+    return 0
+
+
+class AsyncHTTPServer:
+    """ Event loop server for a BaseHTTPRequestHandler subclass """
+
+    def __init__(self,
+                 handler_class,
+                 handler_kwargs: dict,
+                 workers: int = 16):
+        self.handler_class = type(
+            f'Buffered{handler_class.__name__}',
+            (BufferedHandlerMixin, handler_class),
+            {}
+        )
+        self.handler_kwargs = handler_kwargs
+        self.idle_timeout = handler_kwargs.get('idle_timeout')
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='analysis'
+        )
+        self.draining = False
+        self.loop = None
+        self.stopping = None
+
+        # Writers of connections waiting for their next request
+        self.idle = set()
+
+    def handle_request(self, request: bytes, client_address, n_served: int):
+        handler = self.handler_class(
+            request, client_address, self, n_served, **self.handler_kwargs
+        )
+        return (handler.wfile.getvalue(), handler.close_connection,
+                handler.file_part)
+
+    async def read_request(self, reader: asyncio.StreamReader) -> bytes | None:
+        # Returns the raw request, or None if the client went away
+        try:
+            async with asyncio.timeout(self.idle_timeout):
+                head = await reader.readuntil(b'\r\n\r\n')
+        except (TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+        length = content_length(head)
+        if length > MAX_BODY_SIZE:
+            raise ValueError('Request body too large')
+
+        try:
+            async with asyncio.timeout(self.idle_timeout):
+                body = await reader.readexactly(length)
+        except (TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+        return head + body
+
+    async def handle_connection(self,
+                                reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        loop = asyncio.get_running_loop()
+        client_address = writer.get_extra_info('peername')
+        n_served = 0
+
+        try:
+            while not self.draining:
+                self.idle.add(writer)
+                try:
+                    request = await self.read_request(reader)
+                except (ValueError, asyncio.LimitOverrunError):
+                    writer.write(TOO_LARGE)
+                    break
+                finally:
+                    self.idle.discard(writer)
+
+                if request is None:
+                    break
+
+                if request.startswith(b'POST'):
+                    # May block on upstream APIs (e.g. /analyze)
+                    response, close, file_part = await loop.run_in_executor(
+                        self.executor, self.handle_request,
+                        request, client_address, n_served
+                    )
+                else:
+                    response, close, file_part = self.handle_request(
+                        request, client_address, n_served
+                    )
+
+                n_served += 1
+                writer.write(response)
+                if file_part is not None:
+                    if not await self.send_file(writer, *file_part):
+                        # Truncated, so the body is short of its
+                        # Content-Length
+                        break
+                await writer.drain()
+
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def send_file(self, writer: asyncio.StreamWriter, f,
+                        offset: int, count: int) -> bool:
+        # Send `count` bytes of `f` from `offset` after the buffered head,
+        # with os.sendfile where the transport supports it, else in chunks
+        # read off the loop. Returns False if the file was short
+        with f:
+            sent = await self.loop.sendfile(writer.transport, f, offset,
+                                            count)
+        return sent == count
+
+    async def serve(self, port: int,
+                    sock: socket.socket | None = None) -> None:
+        # Serve on `port`, or on an already listening `sock`
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_server(
+            self.handle_connection, port=None if sock else port, sock=sock,
+            limit=MAX_HEAD_SIZE
+        )
+        async with server:
+            await self.stopping.wait()
+
+            # Stop accepting, then wait for the connections to close. Idle
+            # ones are closed now, the rest after their current response
+            server.close()
+            for writer in self.idle:
+                writer.close()
+            await server.wait_closed()
+
+    def drain(self) -> None:
+        # May be called from a signal handler or another thread
+        self.draining = True
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    def serve_forever(self, port: int,
+                      sock: socket.socket | None = None) -> None:
+        try:
+            asyncio.run(self.serve(port, sock))
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,38 +1,70 @@
 """
 Provides flexible authentication by matching the hashed credentials with the correct hash
 stored on the server. The user may optionally be IP banned after a specified number of
-failed attempts - this behaviour is enabled by default.
+failed attempts - this behaviour is enabled by default. Authenticated clients may also be
+issued a signed session cookie (see sessions.py) which is accepted in place of credentials.
 Use `python server.py --help` for more information.
 """
 
+import os
 import json
 import base64
 import hashlib
+import threading
 from enum import Enum
 from typing import Optional
 from http.server import BaseHTTPRequestHandler
 from http.client import HTTPMessage
 
+from metrics import AUTH_OUTCOMES
+from prefork import file_lock
+from profiling import span
+from sessions import SessionManager
+
 class AuthStatus(Enum):
     SUCCESS = 1
     RETRY = 0
     FAIL = -1
 
 class Authenticator:
+    """
+        Failed attempts are counted in memory and written to `auth_file` in
+        batches, at most once every `flush_interval` seconds and only when a
+        count changed. A single instance is shared by all handler threads,
+        so the status of each request is returned rather than stored.
+
+        With `shared` (several server processes), the attempts are instead
+        updated in `auth_file` straight away under a file lock, and reloaded
+        whenever another process has replaced the file
+    """
+
     def __init__(self,
                  ban: bool = True,
                  n_attempts: int = 3,
-                 auth_file: str = 'auth.json'):
+                 auth_file: str = 'auth.json',
+                 flush_interval: float = 1.0,
+                 sessions: SessionManager | None = None,
+                 shared: bool = False):
         self.ban = ban
         self.nattempts = n_attempts
         self.authf = auth_file
-        self.status = AuthStatus.RETRY
+        self.flush_interval = flush_interval
+        self.sessions = sessions
+        self.shared = shared
+        self.version = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.dirty = False
+        self.timer = None
         self.authd = self.load_auth()
-    
-    def load_auth(self) -> Optional[str]:
+        if self.authd is not None:
+            self.authd.setdefault('attempts', {})
+
+    def load_auth(self) -> Optional[dict]:
         try:
             with open(self.authf, "r") as f:
                 authd = json.load(f)
+                self.version = self.file_version(f.fileno())
                 if 'hash' not in authd:
                     raise FileNotFoundError
                 else:
@@ -44,14 +76,86 @@ class Authenticator:
             return None
 
     def save_auth(self) -> None:
+        # Write atomically so a crash can't leave a truncated file
         try:
             if not hasattr(self, 'authd'):
                 raise ValueError
-            with open(self.authf, "w") as f:
-                json.dump(self.authd, f)
+            with self.write_lock:
+                with self.lock:
+                    authd = {**self.authd,
+                             'attempts': dict(self.authd['attempts'])}
+                    self.dirty = False
+                tmp_path = f'{self.authf}.tmp'
+                with open(tmp_path, "w") as f:
+                    json.dump(authd, f)
+                os.replace(tmp_path, self.authf)
+                self.version = self.file_version()
         except ValueError:
             print("Auth dict does not exist")
 
+    def file_version(self, fd: int | None = None) -> tuple[int, int] | None:
+        # The file is replaced on every write, so its inode changes even
+        # when its mtime doesn't
+        try:
+            st = os.stat(fd if fd is not None else self.authf)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def sync(self) -> None:
+        # Reload the attempts if another process wrote them
+        if self.file_version() == self.version:
+            return
+        try:
+            with open(self.authf, "r") as f:
+                attempts = json.load(f).get('attempts', {})
+                version = self.file_version(f.fileno())
+        except (OSError, ValueError):
+            return
+        with self.lock:
+            self.authd['attempts'] = attempts
+            self.version = version
+
+    def update_shared(self, client_addr: str, failed: bool) -> int:
+        # Count a failed attempt (or reset the count) in the file itself,
+        # holding a lock so concurrent processes don't lose updates. Returns
+        # the client's attempts
+        with file_lock(f'{self.authf}.lock'):
+            self.sync()
+            with self.lock:
+                auth_attempts = self.authd['attempts']
+                if failed:
+                    auth_attempts[client_addr] = (
+                        auth_attempts.get(client_addr, 0) + 1
+                    )
+                else:
+                    auth_attempts.pop(client_addr, None)
+                client_attempts = auth_attempts.get(client_addr, 0)
+            self.save_auth()
+        return client_attempts
+
+    def mark_dirty(self) -> None:
+        # Schedule a write unless one is already pending. Must hold `lock`
+        self.dirty = True
+        if self.timer is None:
+            self.timer = threading.Timer(self.flush_interval, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self) -> None:
+        with self.lock:
+            self.timer = None
+            if not self.dirty:
+                return
+        self.save_auth()
+
+    def close(self) -> None:
+        # Write any pending changes, e.g. on shutdown
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        self.flush()
+
     def authenticate(self, headers: HTTPMessage) -> bool:
         # If the authentication header is present, extract the authentication
         # string sent from the client
@@ -63,55 +167,89 @@ class Authenticator:
         
         return hash_str == self.hash
 
-    def handle_auth(self, handler: BaseHTTPRequestHandler) -> None:
+    def get_user(self, headers: HTTPMessage) -> str:
+        # Username from an (authenticated) Basic authentication header
+        authstr = headers['Authorization'].split()[-1]
+        return base64.b64decode(authstr).decode(errors='replace').partition(':')[0]
+
+    def handle_auth(self, handler: BaseHTTPRequestHandler) -> AuthStatus:
         if self.authd is None:
             # Disable authentication
-            self.status = AuthStatus.SUCCESS
-            return
+            return AuthStatus.SUCCESS
+
+        if self.shared:
+            self.sync()
 
         client_addr = handler.client_address[0]
-        auth_attempts = self.authd.get('attempts', {})
+        auth_attempts = self.authd['attempts']
         client_attempts = auth_attempts.get(client_addr, 0)
 
         if self.ban and client_attempts >= self.nattempts:
             # Client was previously banned
-            self.status = AuthStatus.FAIL
-            return
+            AUTH_OUTCOMES.inc('banned')
+            return AuthStatus.FAIL
+
+        if self.sessions is not None:
+            # A valid session cookie stands in for the credentials
+            session = self.sessions.verify(handler.headers.get('Cookie'))
+            if session is not None:
+                handler.auth_user = session.user
+                handler.session_id = session.sid
+                if self.sessions.needs_renewal(session):
+                    handler.session_cookie = self.sessions.issue(
+                        session.user, session.sid
+                    )
+                AUTH_OUTCOMES.inc('session')
+                return AuthStatus.SUCCESS
 
         if 'Authorization' not in handler.headers:
             # Client did not provide authentication
-            self.status = AuthStatus.RETRY
-            return
+            AUTH_OUTCOMES.inc('missing')
+            return AuthStatus.RETRY
     
         # Perform authentication
         if self.authenticate(handler.headers):
             # Success, reset attempts
-            auth_attempts.pop(client_addr, None)
-            self.authd['attempts'] = auth_attempts
-            self.save_auth()
-            self.status = AuthStatus.SUCCESS
-        else:
-            self.status = AuthStatus.RETRY
-            if self.ban:
-                # Increment attempts
-                client_attempts += 1
-                auth_attempts[client_addr] = client_attempts
-                self.authd['attempts'] = auth_attempts
-                self.save_auth()
-                print('IP: {} has {} failed attempts'.format(
-                    client_addr, client_attempts
-                ))
-    
-                if client_attempts >= self.nattempts:
-                    # Ban user IP
-                    self.status = AuthStatus.FAIL
-    
-    def get_status(self, as_value: bool = False) -> AuthStatus:
-        return self.status.value if as_value else self.status
+            if self.shared:
+                if client_addr in auth_attempts:
+                    self.update_shared(client_addr, failed=False)
+            else:
+                with self.lock:
+                    if auth_attempts.pop(client_addr, None) is not None:
+                        self.mark_dirty()
+            handler.auth_user = self.get_user(handler.headers)
+            if self.sessions is not None:
+                handler.session_id = self.sessions.new_sid()
+                handler.session_cookie = self.sessions.issue(
+                    handler.auth_user, handler.session_id
+                )
+            AUTH_OUTCOMES.inc('success')
+            return AuthStatus.SUCCESS
+
+        status = AuthStatus.RETRY
+        if self.ban:
+            # Increment attempts
+            if self.shared:
+                client_attempts = self.update_shared(client_addr, failed=True)
+            else:
+                with self.lock:
+                    client_attempts = auth_attempts.get(client_addr, 0) + 1
+                    auth_attempts[client_addr] = client_attempts
+                    self.mark_dirty()
+            print('IP: {} has {} failed attempts'.format(
+                client_addr, client_attempts
+            ))
+
+            if client_attempts >= self.nattempts:
+                # Ban user IP
+                status = AuthStatus.FAIL
+
+        AUTH_OUTCOMES.inc('failure' if status == AuthStatus.RETRY else 'ban')
+        return status
 
     def handle_auth_and_get_status(self,
                                    handler: BaseHTTPRequestHandler,
-                                   as_value: bool = False) -> AuthStatus:
-        self.handle_auth(handler)
-        return self.get_status(as_value)
-
+                                   as_value: bool = False) -> AuthStatus | int:
+        with span('auth'):
+            status = self.handle_auth(handler)
+        return status.value if as_value else status
@@ -0,0 +1,176 @@
+"""
+Scores form records offline, e.g. to re-score historical submissions after a
+change to weights.json. Records are read from a JSONL file (or stdin), one form
+per line, and missing inputs are filled from default_input.json as for
+/submit. Chunks of records are scored on a pool of processes and the results
+are written as JSONL in input order, with only a few chunks in memory at once.
+
+Each result is {"line": n, "profile": {...}}, or {"line": n, "error": "..."}
+if the record could not be scored. Movie data and pet images are only fetched
+with --fetch, which needs network access and is much slower.
+
+Run from src/ (like server.py), e.g.
+    python batch_score.py forms.jsonl -o profiles.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from collections import deque
+
+from analysis import create_profile
+from scoring import shared_engine
+from server_utils import load_defaults, fill_defaults
+
+
+DESC = "Batch scoring of psychological forms."
+
+
+def read_chunks(f, chunk_size: int):
+    # Yields lists of (line number, line), skipping blank lines
+    chunk = []
+    for line_no, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        chunk.append((line_no, line))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def load_record(line: str, default: dict) -> dict:
+    form_input = json.loads(line)
+    if not isinstance(form_input, dict):
+        raise ValueError('Record must be a JSON object')
+    return fill_defaults(form_input, default)
+
+
+def score_chunk(chunk: list[tuple[int, str]],
+                default: dict,
+                fetch: bool = False) -> tuple[list[str], int]:
+    # Returns the serialised result of each record in the chunk, and how
+    # many of them failed. Runs in a worker process
+    results = {}
+    forms, answers = [], []
+    engine = shared_engine.get()
+
+    for line_no, line in chunk:
+        try:
+            form_input = load_record(line, default)
+            if fetch:
+                results[line_no] = {'profile': create_profile(form_input)}
+                continue
+            answers.append(engine.parse(form_input))
+            forms.append((line_no, form_input))
+        except Exception as e:
+            results[line_no] = {'error': f'{type(e).__name__}: {e}'}
+
+    # Without fetching, the chunk is scored in one pass (see scoring.py)
+    if forms:
+        scores = engine.suitabilities(answers)
+        for (line_no, form_input), row in zip(forms, scores):
+            try:
+                results[line_no] = {'profile': engine.profile(form_input, row)}
+            except Exception as e:
+                results[line_no] = {'error': f'{type(e).__name__}: {e}'}
+
+    lines = [
+        json.dumps({'line': line_no, **results[line_no]})
+        for line_no, _ in chunk
+    ]
+    n_errors = sum('error' in r for r in results.values())
+
+    return lines, n_errors
+
+
+class Progress:
+    """ Reports throughput on stderr every `interval` seconds """
+
+    def __init__(self, interval: float = 5.0):
+        self.interval = interval
+        self.start = self.reported = time.monotonic()
+        self.records = 0
+        self.errors = 0
+
+    def update(self, n_records: int, n_errors: int) -> None:
+        self.records += n_records
+        self.errors += n_errors
+        if self.interval and time.monotonic() - self.reported >= self.interval:
+            self.reported = time.monotonic()
+            self.report()
+
+    def report(self, prefix: str = '') -> None:
+        elapsed = time.monotonic() - self.start
+        rate = self.records / elapsed if elapsed else 0
+        print(f'{prefix}{self.records} records ({self.errors} errors) in '
+              f'{elapsed:.1f}s: {rate:.0f} records/s', file=sys.stderr)
+
+
+def main(args: argparse.Namespace) -> None:
+    default = load_defaults(args.defaults)
+    progress = Progress(args.report_interval)
+
+    fin = sys.stdin if args.input == '-' else open(args.input, 'r')
+    fout = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+    # At most this many chunks are read ahead of the output
+    max_pending = args.workers * 2
+
+    try:
+        with multiprocessing.Pool(args.workers) as pool:
+            pending = deque()
+
+            def write_next() -> None:
+                lines, n_errors = pending.popleft().get()
+                fout.write('\n'.join(lines) + '\n')
+                progress.update(len(lines), n_errors)
+
+            for chunk in read_chunks(fin, args.chunk_size):
+                pending.append(pool.apply_async(
+                    score_chunk, (chunk, default, args.fetch)
+                ))
+                if len(pending) >= max_pending:
+                    write_next()
+
+            while pending:
+                write_next()
+    finally:
+        if fin is not sys.stdin:
+            fin.close()
+        if fout is not sys.stdout:
+            fout.close()
+        else:
+            fout.flush()
+
+    progress.report('Scored ')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=DESC)
+    parser.add_argument('input', nargs='?', default='-',
+                        help='JSONL file of form records (default stdin)')
+    parser.add_argument('-o', '--output', default='-',
+                        help='JSONL file for the results (default stdout)')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=os.cpu_count() or 1,
+                        help='scoring processes (default one per CPU)')
+    parser.add_argument('-c', '--chunk-size', type=int, default=1000,
+                        help='records per chunk sent to a process '
+                             '(default 1000)')
+    parser.add_argument('--fetch', action='store_true', default=False,
+                        help='also fetch movie data and pet images, as '
+                             '/analyze does (slow, needs network access)')
+    parser.add_argument('--defaults', default='default_input.json',
+                        help='inputs for keys missing from a record '
+                             '(default default_input.json)')
+    parser.add_argument('--report-interval', type=float, default=5.0,
+                        help='seconds between throughput reports on stderr, '
+                             '0 for only a summary (default 5)')
+    args = parser.parse_args()
+
+    main(args)
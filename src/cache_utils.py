@@ -0,0 +1,519 @@
+"""
+In-memory caches that let the server answer repeat requests without going back
+to the disk, or to the upstream APIs, and a size-capped store for downloaded
+images. Large binary files and the stored images are not held in memory, but
+sent from disk with sendfile.
+"""
+
+import os
+import re
+import json
+import gzip
+import zlib
+import time
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from email.utils import formatdate
+
+from prefork import file_lock
+from response_utils import load_content
+
+
+# Compressors for each supported Content-Encoding. `mtime=0` keeps the
+# gzip output (and hence its ETag) stable across restarts
+COMPRESSORS = {
+    'gzip': lambda body: gzip.compress(body, compresslevel=9, mtime=0),
+    'deflate': lambda body: zlib.compress(body, 9),
+}
+
+# Name of a file in the image store: the SHA-256 of its content and its
+# extension
+IMAGE_NAME = re.compile(r'[0-9a-f]{64}\.[a-z]+')
+
+
+class Asset:
+    """ Encoded file content along with its cache validators """
+    def __init__(self,
+                 path: str,
+                 ctype: str,
+                 body: bytes,
+                 mtime_ns: int,
+                 compress: bool = False):
+        self.path = path
+        self.ctype = ctype
+        self.body = body
+        self.mtime_ns = mtime_ns
+        self.checked = time.monotonic()
+
+        # Strong validator derived from the exact bytes sent
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+        # HTTP dates have a resolution of one second
+        self.mtime = mtime_ns // 1_000_000_000
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+
+        # Compressed variants, built once. Each encoding is a different
+        # representation, so it gets its own strong ETag
+        self.compressible = compress
+        self.encodings = {}
+        if compress:
+            for encoding, compressor in COMPRESSORS.items():
+                encoded = compressor(body)
+                if len(encoded) < len(body):
+                    self.encodings[encoding] = (
+                        encoded, f'{self.etag[:-1]}-{encoding}"'
+                    )
+
+    def variant(self, encoding: str | None) -> tuple[bytes, str]:
+        # Returns the body and ETag for the given content coding
+        if encoding is None:
+            return self.body, self.etag
+        return self.encodings[encoding]
+
+
+class FileAsset:
+    """
+        A binary file too large to keep in memory. Only its validators are
+        cached; the content is sent from disk (see response_utils.send_file)
+    """
+
+    def __init__(self, path: str, ctype: str, size: int, mtime_ns: int):
+        self.path = path
+        self.ctype = ctype
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.checked = time.monotonic()
+        self.compressible = False
+        self.encodings = {}
+
+        # Strong validator from the file's identity, as hashing the content
+        # would mean reading it all
+        self.etag = f'"{mtime_ns:x}-{size:x}"'
+
+        self.mtime = mtime_ns // 1_000_000_000
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+
+    def variant(self, encoding: str | None) -> tuple[None, str]:
+        # There is no body in memory to send
+        return None, self.etag
+
+
+class AssetCache:
+    """
+        Static assets keyed by path and invalidated by mtime. Each entry is
+        re-validated against the disk at most once every `check_interval`
+        seconds, so repeat fetches are served straight from memory.
+        Assets of a compressible type are kept precompressed if they are at
+        least `min_compress_size` bytes. Binary files of at least
+        `sendfile_threshold` bytes are cached as FileAssets instead.
+    """
+
+    def __init__(self,
+                 check_interval: float = 1.0,
+                 compressible_types: set[str] | None = None,
+                 min_compress_size: int = 1024,
+                 sendfile_threshold: int | None = None):
+        self.check_interval = check_interval
+        self.compressible_types = compressible_types or set()
+        self.min_compress_size = min_compress_size
+        self.sendfile_threshold = sendfile_threshold
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def get(self, path: str, ctype: str,
+            rmode: str) -> Asset | FileAsset | None:
+        # Returns the cached asset, (re)loading it if the file changed.
+        # Returns None if the file does not exist. Read errors propagate
+        asset = self.assets.get(path)
+        now = time.monotonic()
+
+        if asset is not None and now - asset.checked < self.check_interval:
+            return asset
+
+        try:
+            st = os.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            self.discard(path)
+            return None
+        mtime_ns = st.st_mtime_ns
+
+        if asset is not None and asset.mtime_ns == mtime_ns:
+            asset.checked = now
+            return asset
+
+        if (rmode == 'rb' and self.sendfile_threshold is not None
+                and st.st_size >= self.sendfile_threshold):
+            asset = FileAsset(path, ctype, st.st_size, mtime_ns)
+            with self.lock:
+                self.assets[path] = asset
+            return asset
+
+        body = load_content(path, ctype, rmode)
+        compress = (
+            ctype in self.compressible_types
+            and len(body) >= self.min_compress_size
+        )
+        asset = Asset(path, ctype, body, mtime_ns, compress)
+        with self.lock:
+            self.assets[path] = asset
+
+        return asset
+
+    def discard(self, path: str) -> None:
+        with self.lock:
+            self.assets.pop(path, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.assets.clear()
+
+
+class ViewCache:
+    """
+        Serialised responses of the user data views (/view/input and
+        /view/profile), built once and kept until the storage writes the
+        user's data (see Storage.add_listener), so repeat views cost no
+        reads or parsing. Views of the `max_users` most recently active
+        users are kept.
+
+        Writes by other server processes aren't notified, so with several
+        workers `version` (e.g. Storage.version) is given as well, and a
+        user's views are only served while its value is unchanged
+    """
+
+    def __init__(self,
+                 min_compress_size: int = 1024,
+                 max_users: int = 1024,
+                 version=None):
+        self.min_compress_size = min_compress_size
+        self.max_users = max_users
+        self.version = version
+
+        # User -> (version, {view: Asset or None})
+        self.views = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, user: str, view: str, load) -> Asset | None:
+        # Returns the user's view, built from `load()` (returning the data,
+        # or None if there is none) if not cached
+        version = self.version(user) if self.version is not None else None
+        with self.lock:
+            if (entry := self.views.get(user)) is not None:
+                if entry[0] != version:
+                    # Written by another server process
+                    del self.views[user]
+                else:
+                    self.views.move_to_end(user)
+                    if view in entry[1]:
+                        return entry[1][view]
+            generation = self.generation
+
+        asset = None
+        if (data := load()) is not None:
+            data['status'] = 'ok'
+            body = json.dumps(data).encode()
+            asset = Asset(view, 'application/json', body, time.time_ns(),
+                          len(body) >= self.min_compress_size)
+
+        with self.lock:
+            # Don't keep the view if the data was written while building it
+            if self.generation == generation:
+                entry = self.views.get(user)
+                if entry is None or entry[0] != version:
+                    entry = self.views[user] = (version, {})
+                entry[1][view] = asset
+                self.views.move_to_end(user)
+                while len(self.views) > self.max_users:
+                    self.views.popitem(last=False)
+
+        return asset
+
+    def invalidate(self, user: str | None) -> None:
+        # Forget the views of `user`, or of everyone if None
+        with self.lock:
+            self.generation += 1
+            if user is None:
+                self.views.clear()
+            else:
+                self.views.pop(user, None)
+
+
+class MovieCache:
+    """
+        OMDb movie data keyed by (title, year), held in memory and persisted
+        to `path`. Entries are fresh for `ttl` seconds; stale entries are
+        only used if OMDb can't be reached
+    """
+
+    def __init__(self,
+                 path: str = os.path.join('cache', 'omdb.json'),
+                 ttl: float = 7 * 86400):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self) -> dict:
+        # Entries are {'data': OMDb data with `local_poster`, 'fetched': time}
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            print(f'Ignoring corrupt movie cache `{self.path}`: {e}')
+            return {}
+
+    def save(self) -> None:
+        # Called with the lock held
+        if (cache_dir := os.path.dirname(self.path)):
+            os.makedirs(cache_dir, exist_ok=True)
+        # Per process, since server workers (see prefork.py) share the file
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.path)
+
+    def key(self, movie_info: dict[str]) -> str:
+        return f"{movie_info['title'].lower()}|{movie_info['year']}"
+
+    def fresh(self, movie_info: dict[str]) -> bool:
+        entry = self.entries.get(self.key(movie_info))
+        return entry is not None and time.time() - entry['fetched'] < self.ttl
+
+    def get(self, movie_info: dict[str], stale: bool = False) -> dict | None:
+        # Returns a copy of the movie data, or None if not cached (or
+        # expired, unless `stale`). A poster that has since been removed
+        # from disk is returned as None
+        entry = self.entries.get(self.key(movie_info))
+        if entry is None:
+            return None
+        if not stale and time.time() - entry['fetched'] >= self.ttl:
+            return None
+
+        movie_data = dict(entry['data'])
+        local_poster = movie_data.get('local_poster')
+        if local_poster is not None and not os.path.isfile(local_poster):
+            movie_data['local_poster'] = None
+        return movie_data
+
+    def put(self, movie_info: dict[str], movie_data: dict) -> None:
+        entry = {'data': dict(movie_data), 'fetched': time.time()}
+        with self.lock:
+            self.entries[self.key(movie_info)] = entry
+            try:
+                self.save()
+            except OSError as e:
+                # Still cached in memory
+                print(f'Failed to save movie cache `{self.path}`: {e}')
+
+    def set_poster(self, movie_info: dict[str], local_poster: str) -> None:
+        # Record a downloaded poster, keeping the entry's age
+        with self.lock:
+            if (entry := self.entries.get(self.key(movie_info))) is None:
+                return
+            entry['data'] = {**entry['data'], 'local_poster': local_poster}
+            try:
+                self.save()
+            except OSError as e:
+                print(f'Failed to save movie cache `{self.path}`: {e}')
+
+
+class ImageStore:
+    """
+        Downloaded images in `image_dir`, named by the SHA-256 of their
+        content so identical images are stored once. An index maps each
+        source URL to its file, and the least recently used files are
+        evicted once the store exceeds `max_bytes`.
+
+        Server workers (see prefork.py) share the directory. Each download
+        merges the index saved by the others under a file lock before
+        evicting and saving, so the budget covers every worker's files
+    """
+
+    def __init__(self,
+                 image_dir: str = 'images',
+                 max_bytes: int = 256 * 1024 * 1024):
+        self.image_dir = image_dir
+        self.index_path = os.path.join(image_dir, 'index.json')
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        # File name -> size, least recently used first, and URL -> file name
+        self.files = OrderedDict()
+        self.urls = {}
+        self.total = 0
+
+        # Files used since the index was last merged
+        self.touched = {}
+        self.load()
+
+    def read_index(self) -> dict | None:
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError as e:
+            print(f'Ignoring corrupt image index `{self.index_path}`: {e}')
+            return None
+
+    def load(self) -> None:
+        if (index := self.read_index()) is None:
+            return
+
+        # Drop entries whose files were removed
+        for name, size in index['files']:
+            if os.path.isfile(os.path.join(self.image_dir, name)):
+                self.files[name] = size
+                self.total += size
+        self.urls = {
+            url: name for url, name in index['urls'].items()
+            if name in self.files
+        }
+
+    def merge(self) -> None:
+        # Take up the files, URLs and evictions of the other workers from
+        # the saved index, with the files used here since the last merge as
+        # the most recently used. Called with both locks held
+        if (index := self.read_index()) is None:
+            return
+
+        files = OrderedDict(index['files'])
+        for name in self.touched:
+            if name in files:
+                files.move_to_end(name)
+        self.touched.clear()
+
+        self.files = files
+        self.total = sum(files.values())
+        self.urls = {
+            url: name for url, name in {**index['urls'], **self.urls}.items()
+            if name in files
+        }
+
+    def save(self) -> None:
+        # Called with both locks held
+        tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': list(self.files.items()), 'urls': self.urls},
+                      f)
+        os.replace(tmp_path, self.index_path)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.image_dir, name)
+
+    def has(self, name: str) -> bool:
+        with self.lock:
+            if name in self.files:
+                return True
+
+        # Possibly downloaded by another server process sharing the
+        # directory (see prefork.py), so adopt it
+        if not IMAGE_NAME.fullmatch(name):
+            return False
+        try:
+            size = os.stat(self.path(name)).st_size
+        except OSError:
+            return False
+        with self.lock:
+            if name not in self.files:
+                self.files[name] = size
+                self.total += size
+        return True
+
+    def lookup(self, url: str) -> str | None:
+        # Returns the local path of the image downloaded from `url`, if any
+        with self.lock:
+            if (name := self.urls.get(url)) is None:
+                return None
+            if not os.path.isfile(self.path(name)):
+                # Evicted by another server process
+                del self.urls[url]
+                self.total -= self.files.pop(name, 0)
+                return None
+            self.files.move_to_end(name)
+            self.touched[name] = None
+        return self.path(name)
+
+    def add(self, url: str, chunks, extn: str, max_size: int) -> str:
+        # Write the image streamed in `chunks` (bytes) to the store and
+        # return its local path. Raises ValueError if it exceeds `max_size`
+        os.makedirs(self.image_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+
+        with tempfile.NamedTemporaryFile('wb', dir=self.image_dir,
+                                         prefix='.download-',
+                                         delete=False) as f:
+            try:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_size:
+                        raise ValueError(f'Image larger than {max_size} bytes')
+                    digest.update(chunk)
+                    f.write(chunk)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+
+        name = f'{digest.hexdigest()}.{extn}'
+        with self.lock, file_lock(f'{self.index_path}.lock'):
+            self.merge()
+            if name in self.files:
+                # Same image from another URL
+                os.remove(f.name)
+            else:
+                os.replace(f.name, self.path(name))
+                self.files[name] = size
+                self.total += size
+            self.files.move_to_end(name)
+            self.urls[url] = name
+            self.evict()
+            self.save()
+
+        return self.path(name)
+
+    def evict(self) -> None:
+        # Remove least recently used files until within budget, always
+        # keeping the newest. Called with the lock held
+        evicted = set()
+        while self.total > self.max_bytes and len(self.files) > 1:
+            name, size = self.files.popitem(last=False)
+            self.total -= size
+            evicted.add(name)
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+
+        if evicted:
+            self.urls = {
+                url: name for url, name in self.urls.items()
+                if name not in evicted
+            }
+
+    def clear(self) -> None:
+        with self.lock:
+            if os.path.isdir(self.image_dir):
+                with file_lock(f'{self.index_path}.lock'):
+                    self.merge()
+                    self.remove_all()
+                    self.save()
+            else:
+                self.remove_all()
+
+    def remove_all(self) -> None:
+        # Called with the lock held
+        for name in self.files:
+            try:
+                os.remove(self.path(name))
+            except FileNotFoundError:
+                pass
+        self.files.clear()
+        self.urls.clear()
+        self.total = 0
@@ -2,9 +2,24 @@
 Helper functions for fetching data, enabling the server to act as a client.
 """
 
-import os
+import time
+import random
 import requests
 from datetime import datetime
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+from cache_utils import ImageStore
+from metrics import UPSTREAM_REQUESTS, UPSTREAM_DURATION
+from profiling import span
+
+
+# Responses to a GET that are worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Images are streamed to disk in chunks, up to a maximum size
+IMAGE_CHUNK_SIZE = 64 * 1024
+MAX_IMAGE_SIZE = 20 * 1024 * 1024
 
 
 def format_response_date(date: str) -> str:
@@ -22,12 +37,86 @@ def print_response_info(uri: str, response: requests.Response) -> None:
     print(f"(Server) - - [{date}] \"GET {uri}\" {status} -")
 
 
+class HTTPClient:
+    """
+        Shared client for the upstream APIs. Connections are kept alive in a
+        pool of up to `pool_size` per host, every request has a connect and
+        read timeout, and failed GETs are retried with jittered exponential
+        backoff. Safe to use from many threads
+    """
+
+    def __init__(self,
+                 pool_size: int = 16,
+                 connect_timeout: float = 3.05,
+                 read_timeout: float = 10.0,
+                 retries: int = 2,
+                 backoff: float = 0.25):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+        # Retries are handled in `get`, not by urllib3
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_size,
+                              max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, uri: str, **kwargs) -> requests.Response:
+        host = urlsplit(uri).hostname or 'unknown'
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            start = time.perf_counter()
+            try:
+                response = self.session.get(uri, timeout=self.timeout,
+                                            **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                UPSTREAM_REQUESTS.inc(host, type(e).__name__)
+                if last:
+                    raise
+            else:
+                UPSTREAM_DURATION.observe(time.perf_counter() - start, host)
+                UPSTREAM_REQUESTS.inc(host, f'{response.status_code // 100}xx')
+                if last or response.status_code not in RETRY_STATUSES:
+                    return response
+                response.close()
+
+            # Full jitter, so concurrent retries don't arrive together
+            time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def close(self) -> None:
+        self.session.close()
+
+
+client = HTTPClient()
+
+
+def configure_client(**kwargs) -> None:
+    # Replace the shared client, e.g. with settings from the command line.
+    # Call before any requests are made
+    global client
+    client.close()
+    client = HTTPClient(**kwargs)
+
+
+image_store = ImageStore()
+
+
+def configure_image_store(**kwargs) -> None:
+    # Replace the shared image store, e.g. with settings from the command
+    # line. Call before any images are downloaded
+    global image_store
+    image_store = ImageStore(**kwargs)
+
+
 def fetch_data(uri: str,
                json: bool = True,
-               quiet: bool = False) -> dict | list | requests.Response:
+               quiet: bool = False,
+               stream: bool = False) -> dict | list | requests.Response:
     # General method to fetch (meta)data and print info
 
-    response = requests.get(uri)
+    with span('upstream', urlsplit(uri).hostname):
+        response = client.get(uri, stream=stream)
 
     if not quiet:
         print_response_info(uri, response)
@@ -44,18 +133,30 @@ def check_img(img_path: str) -> bool:
 def download_img(url: str, quiet: bool = True) -> str:
     # Given an image's URL, download it to the server
     # and return the local reference.
-    # The local filename derives from the URL string
+    # Images are kept in the image store, named by their content,
+    # so an image already downloaded from `url` is not fetched again
 
-    response = fetch_data(url, False)
+    if (filename := image_store.lookup(url)) is not None:
+        return filename
 
-    # Dump the response content to the file
-    os.makedirs('images', exist_ok=True)
-    filename = os.path.join('images', url.split('/')[-1])
-    with open(filename, 'wb') as fout:
-        fout.write(response.content)
+    extn = url.split('.')[-1].lower()
+    extn = extn if check_img(extn) else 'jpg'
+
+    # Stream the response content to the store
+    with fetch_data(url, False, stream=True) as response:
+        response.raise_for_status()
+        with span('image_write', urlsplit(url).hostname):
+            filename = image_store.add(
+                url, response.iter_content(IMAGE_CHUNK_SIZE), extn,
+                max_size=MAX_IMAGE_SIZE
+            )
 
     if not quiet:
         print('  ->', filename)
 
     return filename
 
+
+def clear_images() -> None:
+    # Delete every downloaded image
+    image_store.clear()
@@ -0,0 +1,145 @@
+"""
+Background analysis jobs. /analyze enqueues the analysis on a bounded queue
+served by a fixed number of worker threads and answers 202 straight away, so
+the client polls /jobs/<id> instead of holding a connection open through every
+upstream fetch. A dropped connection no longer wastes the analysis.
+"""
+
+import time
+import queue
+import secrets
+import threading
+
+
+# Path prefix of the job status endpoint
+JOB_PATH = '/jobs/'
+
+# Job ids are 12 random bytes, URL-safe base64 encoded
+JOB_ID_LENGTH = 16
+
+
+def new_job_id() -> str:
+    return secrets.token_urlsafe(JOB_ID_LENGTH * 3 // 4)
+
+
+class Job:
+    """ An analysis moving from `queued` to `running` to `done` or `failed` """
+
+    def __init__(self, user: str, task, job_id: str | None = None):
+        self.id = job_id or new_job_id()
+        self.user = user
+        self.task = task
+        self.state = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def status(self) -> dict:
+        # The error (if any) is only logged, not sent to clients
+        return {
+            'job': self.id,
+            'state': self.state,
+            'created': self.created,
+            'finished': self.finished,
+        }
+
+
+class AnalysisQueue:
+    """
+        Runs jobs on `workers` threads. At most `queue_size` jobs wait for a
+        worker, beyond which clients are told to retry after `retry_after`
+        seconds. Finished jobs are kept for `job_ttl` seconds
+    """
+
+    def __init__(self,
+                 workers: int = 2,
+                 queue_size: int = 16,
+                 job_ttl: float = 3600,
+                 retry_after: int = 1):
+        self.workers = workers
+        self.job_ttl = job_ttl
+        self.retry_after = retry_after
+        self.jobs = {}
+        self.pending = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+
+        self.threads = [
+            threading.Thread(target=self.work, name=f'analysis-{i}',
+                             daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, user: str, task,
+               job_id: str | None = None) -> Job | None:
+        # Queue `task` (a callable) to run for `user`, under `job_id` if
+        # given. Returns None if the queue is full
+        job = Job(user, task, job_id)
+        try:
+            self.pending.put_nowait(job)
+        except queue.Full:
+            return None
+
+        with self.lock:
+            self.prune()
+            self.jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def prune(self) -> None:
+        # Forget finished jobs older than `job_ttl`. Called with the lock held
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished is not None and now - job.finished > self.job_ttl
+        ]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def work(self) -> None:
+        while (job := self.pending.get()) is not None:
+            job.state = 'running'
+            try:
+                job.task()
+                job.state = 'done'
+            except Exception as e:
+                print(f'Error during analysis: {e}')
+                job.error = str(e)
+                job.state = 'failed'
+            finally:
+                job.finished = time.time()
+                job.task = None
+
+    def close(self) -> None:
+        # Stop the workers once the queued jobs are done (the threads are
+        # daemons, so a full queue doesn't hold up shutdown)
+        for _ in self.threads:
+            try:
+                self.pending.put_nowait(None)
+            except queue.Full:
+                break
+
+    def join(self, timeout: float | None = None) -> None:
+        # Wait up to `timeout` seconds in all for the workers to finish the
+        # queued jobs, after close()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(
+                None if deadline is None
+                else max(0, deadline - time.monotonic())
+            )
+
+    def stats(self) -> dict:
+        with self.lock:
+            states = [job.state for job in self.jobs.values()]
+        return {
+            'workers': self.workers,
+            'queue_depth': self.pending.qsize(),
+            'queue_size': self.pending.maxsize,
+            **{state: states.count(state)
+               for state in ('queued', 'running', 'done', 'failed')},
+        }
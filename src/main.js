@@ -163,7 +163,22 @@ async function analyze() {
     await resetAllButtons();
     await writeMsg('Analysing...');  // (may take a few seconds)
     const ok = await fetchData('/analyze', "POST");
-    if (ok) await writeMsg(ok.message);  // Send message only
+    if (!ok) return;
+
+    // 202: the analysis was queued, so wait for the job to finish
+    const job = ok.status === 202 ? await waitForJob(ok.job) : ok;
+    if (job) await writeMsg(job.message);  // Send message only
+}
+
+
+// Poll an analysis job until it is done or failed
+async function waitForJob(jobId, interval = 1000) {
+    while (true) {
+        await new Promise(resolve => setTimeout(resolve, interval));
+        const job = await fetchData(`/jobs/${jobId}`);
+        if (!job) return null;
+        if (job.state === 'done' || job.state === 'failed') return job;
+    }
 }
 
 
@@ -292,14 +307,21 @@ async function insertProfile(data) {
         type: "job", score: jobScore, verdict: jobVerdict
     });
 
-    // Create posters from images stored on the server
-    const jobPoster = document.createElement('img');
-    jobPoster.src = jobMovie.local_poster;
-    jobPoster.alt = `Poster for ${jobMovie.Title}`;
-
-    const psychPoster = document.createElement('img');
-    psychPoster.src = psychMovie.local_poster;
-    psychPoster.alt = `Poster for ${psychMovie.Title}`;
+    // Create posters from images stored on the server. A poster may be
+    // missing (null) if it could not be fetched in time
+    const createPoster = (movie) => {
+        if (movie.local_poster == null) {
+            const note = document.createElement('p');
+            note.innerHTML = '<i>(Poster unavailable)</i>';
+            return note;
+        }
+        const poster = document.createElement('img');
+        poster.src = movie.local_poster;
+        poster.alt = `Poster for ${movie.Title}`;
+        return poster;
+    };
+    const jobPoster = createPoster(jobMovie);
+    const psychPoster = createPoster(psychMovie);
 
     // Fill in the template for movie recommendations
     const movieContent = template({
@@ -328,11 +350,16 @@ async function insertProfile(data) {
     let i = 0, showPets = false;
     for (const pet in pets) {
         petContainer.innerHTML += `<p>A <i>${petAdj[i]}</i> <b>${pet}</b>:</p>`;
+        i+=1, showPets = true;  // Not reached if no pets were checked
+        if (pets[pet] == null) {
+            // Could not be fetched in time
+            petContainer.innerHTML += '<p><i>(Image unavailable)</i></p>';
+            continue;
+        }
         const petImg = document.createElement('img');
         petImg.src = pets[pet];
         petImg.alt = `An image of a ${pet}`;
         petContainer.appendChild(petImg);
-        i+=1, showPets = true;  // Not reached if no pets were checked
     }
 
     // Prepare all of the above content
@@ -0,0 +1,190 @@
+"""
+Instrumentation exposed on /metrics in the Prometheus text format. Counters
+and histograms are kept per set of label values, each metric behind its own
+lock which is only held for a dict update, so recording costs well under a
+microsecond and threads rarely contend.
+
+The metrics of the server are defined at the bottom of this module and
+recorded by the request handler, Authenticator, fetch_utils and analysis.
+
+With `--workers` each server process keeps its own metrics and answers
+/metrics with them, so every sample carries a `worker` label (see
+Registry.set_labels). Scrapes landing on different workers then read separate
+series rather than one counter jumping back and forth; sum over `worker` for
+the whole server.
+"""
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Latency buckets (seconds), from a cached asset to a slow upstream
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def escape(value: str) -> str:
+    return (str(value).replace('\\', r'\\').replace('"', r'\"')
+            .replace('\n', r'\n'))
+
+
+class Metric:
+    """ Values of a metric for each combination of its labels """
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (),
+                 const_labels: dict[str, str] | None = None):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.const_labels = const_labels if const_labels is not None else {}
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def label_str(self, values: tuple, extra: str = '') -> str:
+        pairs = [f'{k}="{escape(v)}"' for k, v in zip(self.labels, values)]
+        pairs.extend(f'{k}="{escape(v)}"'
+                     for k, v in self.const_labels.items())
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.doc}',
+                 f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = {k: self.copy(v) for k, v in self.values.items()}
+        for label_values, value in sorted(values.items()):
+            lines.extend(self.samples(label_values, value))
+        return lines
+
+    def copy(self, value):
+        return value
+
+    def samples(self, label_values: tuple, value) -> list[str]:
+        return [f'{self.name}{self.label_str(label_values)} {value}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self.lock:
+            self.values[label_values] = (
+                self.values.get(label_values, 0) + amount
+            )
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+                 const_labels: dict[str, str] | None = None):
+        super().__init__(name, doc, labels, const_labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *label_values) -> None:
+        # Each value is [count per bucket (not cumulative)..., sum, count]
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if (counts := self.values.get(label_values)) is None:
+                counts = self.values[label_values] = (
+                    [0] * (len(self.buckets) + 1) + [0.0, 0]
+                )
+            counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def copy(self, value):
+        return list(value)
+
+    def samples(self, label_values: tuple, value) -> list[str]:
+        lines, cumulative = [], 0
+        bounds = [f'{b:g}' for b in self.buckets] + ['+Inf']
+        for bound, n in zip(bounds, value):
+            cumulative += n
+            labels = self.label_str(label_values, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{labels} {cumulative}')
+        labels = self.label_str(label_values)
+        lines.append(f'{self.name}_sum{labels} {value[-2]}')
+        lines.append(f'{self.name}_count{labels} {value[-1]}')
+        return lines
+
+
+class Registry:
+    """ Collection of metrics rendered together """
+
+    def __init__(self):
+        self.metrics = []
+
+        # Labels of every sample, shared with the metrics
+        self.const_labels = {}
+
+    def set_labels(self, **labels: str) -> None:
+        # e.g. the worker process, set once at startup
+        self.const_labels.update(labels)
+
+    def counter(self, name: str, doc: str, labels=()) -> Counter:
+        self.metrics.append(
+            metric := Counter(name, doc, tuple(labels), self.const_labels)
+        )
+        return metric
+
+    def histogram(self, name: str, doc: str, labels=(),
+                  buckets=DEFAULT_BUCKETS) -> Histogram:
+        self.metrics.append(
+            metric := Histogram(name, doc, tuple(labels), buckets,
+                                self.const_labels)
+        )
+        return metric
+
+    def render(self) -> bytes:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return ('\n'.join(lines) + '\n').encode()
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter(
+    'psych_http_requests_total', 'HTTP requests handled.',
+    ('method', 'route', 'status')
+)
+HTTP_DURATION = REGISTRY.histogram(
+    'psych_http_request_duration_seconds',
+    'Time to handle an HTTP request, from its request line to the response.',
+    ('method', 'route')
+)
+AUTH_OUTCOMES = REGISTRY.counter(
+    'psych_auth_total', 'Authentication outcomes.', ('outcome',)
+)
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    'psych_upstream_requests_total',
+    'Upstream API requests, by result (HTTP status class or error type).',
+    ('host', 'result')
+)
+UPSTREAM_DURATION = REGISTRY.histogram(
+    'psych_upstream_request_duration_seconds',
+    'Time until the response headers of an upstream request.',
+    ('host',)
+)
+ANALYSIS_PHASES = REGISTRY.histogram(
+    'psych_analysis_phase_seconds',
+    'Time spent in each phase of an analysis.',
+    ('phase',)
+)
@@ -0,0 +1,247 @@
+"""
+Admission control for the HTTP server. PooledHTTPServer handles connections
+on a fixed number of worker threads fed by a bounded accept queue, and
+RouteLimiter caps how many requests may run at once on each route. Overflow
+in either is shed with a fast 503 response rather than queued without limit.
+"""
+
+import json
+import time
+import queue
+import socket
+import selectors
+import threading
+import http.server
+
+from prefork import DrainingMixin
+
+
+class RouteLimiter:
+    """
+        Per-route concurrency limits. A request is limited by its exact path
+        if listed, otherwise by its method (e.g. `GET`), otherwise not at all
+    """
+
+    def __init__(self, limits: dict[str, int], retry_after: int = 1):
+        self.limits = limits
+        self.retry_after = retry_after
+        self.semaphores = {
+            route: threading.BoundedSemaphore(n) for route, n in limits.items()
+        }
+        self.active = dict.fromkeys(limits, 0)
+        self.rejected = dict.fromkeys(limits, 0)
+        self.lock = threading.Lock()
+
+    def route(self, method: str, path: str) -> str | None:
+        # Routes are matched without the query string, like the Router
+        path = path.partition('?')[0]
+        if path in self.limits:
+            return path
+        return method if method in self.limits else None
+
+    def acquire(self, route: str | None) -> bool:
+        # Non-blocking: returns False if the route is at its limit
+        if route is None:
+            return True
+
+        if not self.semaphores[route].acquire(blocking=False):
+            with self.lock:
+                self.rejected[route] += 1
+            return False
+
+        with self.lock:
+            self.active[route] += 1
+        return True
+
+    def release(self, route: str | None) -> None:
+        if route is None:
+            return
+
+        with self.lock:
+            self.active[route] -= 1
+        self.semaphores[route].release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                route: {
+                    'limit': self.limits[route],
+                    'active': self.active[route],
+                    'rejected': self.rejected[route],
+                }
+                for route in self.limits
+            }
+
+
+class Rejecter(threading.Thread):
+    """
+        Sheds connections when the queue is full, without holding up the
+        accept loop. Each is sent a prebuilt 503 before its request is read,
+        then drained for up to `linger` seconds, as closing it with the
+        request unread would reset it before the client reads the response.
+        Beyond `max_connections` lingering, connections are closed at once
+    """
+
+    def __init__(self,
+                 retry_after: int = 1,
+                 linger: float = 1.0,
+                 max_connections: int = 256):
+        super().__init__(name='reject', daemon=True)
+        body = json.dumps({
+            'status': 503, 'message': 'Server busy, try again later'
+        }).encode()
+        self.response = (
+            'HTTP/1.1 503 Service Unavailable\r\n'
+            'Content-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Retry-After: {retry_after}\r\n'
+            'Connection: close\r\n\r\n'
+        ).encode() + body
+        self.linger = linger
+        self.incoming = queue.Queue(maxsize=max_connections)
+        self.selector = selectors.DefaultSelector()
+
+        # Lingering socket -> time to close it
+        self.deadlines = {}
+
+    def reject(self, sock: socket.socket) -> None:
+        # Called on the accept thread. Never blocks: the response is far
+        # smaller than the socket's send buffer
+        try:
+            sock.setblocking(False)
+            sock.send(self.response)
+            sock.shutdown(socket.SHUT_WR)
+            self.incoming.put_nowait(sock)
+        except (OSError, queue.Full):
+            sock.close()
+
+    def run(self) -> None:
+        while True:
+            # Wait for a connection only when none are lingering
+            block = not self.deadlines
+            while True:
+                try:
+                    sock = self.incoming.get(block=block)
+                except queue.Empty:
+                    break
+                if sock is None:
+                    for sock in list(self.deadlines):
+                        self.drop(sock)
+                    return
+                self.selector.register(sock, selectors.EVENT_READ)
+                self.deadlines[sock] = time.monotonic() + self.linger
+                block = False
+
+            for key, _ in self.selector.select(timeout=0.05):
+                try:
+                    if key.fileobj.recv(65536):
+                        continue
+                except OSError:
+                    pass
+                # Closed by the client
+                self.drop(key.fileobj)
+
+            now = time.monotonic()
+            for sock, deadline in list(self.deadlines.items()):
+                if now >= deadline:
+                    self.drop(sock)
+
+    def drop(self, sock: socket.socket) -> None:
+        self.selector.unregister(sock)
+        del self.deadlines[sock]
+        sock.close()
+
+    def close(self) -> None:
+        self.incoming.put(None)
+
+
+class PooledHTTPServer(DrainingMixin, http.server.HTTPServer):
+    """
+        Handle connections on `workers` threads. Accepted connections wait in
+        a queue of at most `queue_size`, beyond which they are rejected.
+        While connections wait, keep-alive connections idle for `min_idle`
+        seconds are closed to free their workers
+    """
+
+    min_idle = 1.0
+
+    def __init__(self,
+                 server_address,
+                 RequestHandlerClass,
+                 workers: int = 32,
+                 queue_size: int = 64,
+                 retry_after: int = 1,
+                 bind_and_activate: bool = True):
+        super().__init__(server_address, RequestHandlerClass,
+                         bind_and_activate)
+        self.workers = workers
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.busy = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.rejecter = Rejecter(retry_after)
+        self.rejecter.start()
+
+        self.threads = [
+            threading.Thread(target=self.work, name=f'worker-{i}', daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def saturated(self) -> bool:
+        # Connections are waiting for a worker, so keep-alive connections
+        # should be closed rather than hold on to theirs
+        return not self.requests.empty()
+
+    def work(self) -> None:
+        while (item := self.requests.get()) is not None:
+            request, client_address = item
+            with self.lock:
+                self.busy += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                with self.lock:
+                    self.busy -= 1
+
+    def process_request(self, request, client_address) -> None:
+        try:
+            self.requests.put_nowait((request, client_address))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            self.rejecter.reject(request)
+            return
+
+        # A connection that must wait for a worker takes one from an idle
+        # keep-alive connection, which would otherwise hold it for up to the
+        # idle timeout (closed as when draining)
+        with self.lock:
+            waiting = self.busy + self.requests.qsize() - self.workers
+        if waiting > 0:
+            self.close_idle(waiting, min_idle=self.min_idle)
+
+    def server_close(self) -> None:
+        # Like ThreadingMixIn, wait for the connections being handled (and
+        # those queued) to finish
+        super().server_close()
+        for _ in self.threads:
+            self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.rejecter.close()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'busy': self.busy,
+                'queue_depth': self.requests.qsize(),
+                'queue_size': self.requests.maxsize,
+                'rejected': self.rejected,
+            }
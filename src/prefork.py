@@ -0,0 +1,254 @@
+"""
+Pre-fork serving. The supervisor binds the listening socket and forks
+`workers` processes, each running a complete server (engine, caches, analysis
+queue) that accepts connections from it, so requests are handled on every CPU
+rather than behind one interpreter lock. With `reuse_port` each worker binds a
+socket of its own with SO_REUSEPORT instead, and the kernel spreads new
+connections evenly between them.
+
+Workers that exit are restarted. On SIGTERM (or SIGINT) the supervisor passes
+SIGTERM on to the workers, which drain: they stop accepting, close their idle
+keep-alive connections, finish the requests and queued analyses in progress
+and exit. Workers still running after `drain_timeout` seconds are killed.
+
+Files shared by the workers (auth attempts, the JSON form, the image index)
+are read-modify-written under file_lock().
+"""
+
+import os
+import time
+import socket
+import signal
+import threading
+import traceback
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows, which has no `--workers` either
+    fcntl = None
+
+
+def listen(port: int, reuse_port: bool = False,
+           backlog: int = 128) -> socket.socket:
+    # The socket is non-blocking: when several processes accept on it, all
+    # of them are woken for a connection that only one of them gets
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+@contextmanager
+def file_lock(path: str):
+    # Exclusive lock between processes, held on the file `path` (created if
+    # missing). Threads must still take their own locks
+    with open(path, 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def use_socket(server, sock: socket.socket) -> None:
+    # Serve a socketserver server (created with bind_and_activate=False) on
+    # an already listening socket
+    server.socket.close()
+    server.socket = sock
+    server.server_address = sock.getsockname()
+    server.server_port = server.server_address[1]
+
+
+class DrainingMixin:
+    """
+        Graceful shutdown of a socketserver server. drain() stops accepting
+        and closes the connections idle between keep-alive requests, leaving
+        requests in progress to finish (see MyHandler.end_headers)
+    """
+
+    draining = False
+
+    def __init__(self, *args, **kwargs):
+        # Connection -> time it started waiting for its next request
+        self.idle_connections = {}
+        self.idle_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def set_idle(self, connection: socket.socket, idle: bool) -> bool:
+        # Called by the handler while it waits for the next request line.
+        # Returns False if the connection should be closed instead
+        with self.idle_lock:
+            if self.draining and idle:
+                return False
+            if idle:
+                self.idle_connections[connection] = time.monotonic()
+            else:
+                self.idle_connections.pop(connection, None)
+            return True
+
+    def close_idle(self, limit: int | None = None,
+                   min_idle: float = 0) -> None:
+        # Close (up to `limit` of) the connections that have waited at least
+        # `min_idle` seconds for their next request, freeing the threads
+        # serving them. A client may be sending a request on a connection
+        # as it closes, which `min_idle` makes unlikely
+        with self.idle_lock:
+            since = time.monotonic() - min_idle
+            for connection, idle in list(self.idle_connections.items()):
+                if limit == 0:
+                    break
+                if idle > since:
+                    continue
+                del self.idle_connections[connection]
+                try:
+                    # The handler reads EOF and closes the connection
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+                if limit is not None:
+                    limit -= 1
+
+    def drain(self) -> None:
+        # Safe to call from a signal handler on the serving thread, since
+        # shutdown() waits for serve_forever() to return
+        with self.idle_lock:
+            self.draining = True
+        self.close_idle()
+        threading.Thread(target=self.shutdown, name='drain',
+                         daemon=True).start()
+
+
+class Supervisor:
+    """
+        Forks `workers` processes, each calling `target(sock, index)` with
+        the listening socket, and keeps them running. A worker that exits
+        within `min_uptime` seconds of starting is restarted after
+        `restart_delay` seconds, doubling while it keeps failing
+    """
+
+    def __init__(self,
+                 target,
+                 port: int,
+                 workers: int = 2,
+                 reuse_port: bool = False,
+                 drain_timeout: float = 30,
+                 min_uptime: float = 5,
+                 restart_delay: float = 1):
+        self.target = target
+        self.port = port
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self.min_uptime = min_uptime
+        self.restart_delay = restart_delay
+        self.sock = None
+        self.stopping = None
+
+        # pid -> (index, start time). Workers waiting to be restarted, by
+        # index -> restart time, and the next delay of failing workers
+        self.children = {}
+        self.pending = {}
+        self.delays = {}
+
+    def spawn(self, index: int) -> None:
+        if (pid := os.fork()) != 0:
+            self.children[pid] = (index, time.monotonic())
+            return
+
+        # Worker: install its own signal handlers, serve and never return
+        # into the supervisor
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            sock = self.sock or listen(self.port, reuse_port=True)
+            self.target(sock, index)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self) -> None:
+        # Collect exited workers, scheduling their restart
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            index, started = self.children.pop(pid)
+            if self.stopping is not None:
+                continue
+
+            print(f'Worker {index} (pid {pid}) exited with status '
+                  f'{os.waitstatus_to_exitcode(status)}. Restarting.')
+            if time.monotonic() - started >= self.min_uptime:
+                self.delays.pop(index, None)
+                delay = 0
+            else:
+                delay = self.delays.get(index, self.restart_delay)
+                self.delays[index] = min(2 * delay, 60)
+            self.pending[index] = time.monotonic() + delay
+
+    def signal_workers(self, signum: int) -> None:
+        for pid in self.children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self, signum, _) -> None:
+        if self.stopping is None:
+            self.stopping = time.monotonic()
+        self.signal_workers(signal.SIGTERM)
+
+    def run(self) -> None:
+        if not self.reuse_port:
+            # Shared by every worker, and kept open to pass to restarts
+            self.sock = listen(self.port)
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP,
+                      lambda signum, _: self.signal_workers(signum))
+
+        for index in range(self.workers):
+            self.spawn(index)
+
+        killed = False
+        try:
+            while self.children or (self.stopping is None and self.pending):
+                time.sleep(0.1)
+                self.reap()
+
+                if self.stopping is not None:
+                    waited = time.monotonic() - self.stopping
+                    if not killed and waited > self.drain_timeout:
+                        print(f'Killing {len(self.children)} workers still '
+                              f'draining after {self.drain_timeout}s.')
+                        self.signal_workers(signal.SIGKILL)
+                        killed = True
+                    continue
+
+                now = time.monotonic()
+                for index, due in list(self.pending.items()):
+                    if now >= due:
+                        del self.pending[index]
+                        self.spawn(index)
+        finally:
+            if self.sock is not None:
+                self.sock.close()
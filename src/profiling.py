@@ -0,0 +1,226 @@
+"""
+Opt-in profiling of single requests. A profiled request records a timeline of
+spans (authentication, file reads, scoring, each upstream fetch, storage
+writes), optionally along with a cProfile of the request thread, and writes it
+to a rotating dump directory. A Server-Timing header summarises the spans.
+
+Profiling is enabled per request with an `X-Profile: spans|cprofile` header
+(if allowed) or for a sampled fraction of requests. The current profile is
+held in a context variable, so when no request is being profiled `span` is a
+single lookup returning a shared no-op.
+"""
+
+import os
+import json
+import time
+import random
+import cProfile
+import threading
+import contextvars
+
+
+PROFILE_HEADER = 'X-Profile'
+
+current = contextvars.ContextVar('profile', default=None)
+
+# Only one cProfile can be active in the process at a time
+cprofile_lock = threading.Lock()
+
+
+class NoSpan:
+    """ Span used when profiling is disabled """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Span:
+    """ Records its duration to a profile """
+
+    __slots__ = ('profile', 'name', 'desc', 'start')
+
+    def __init__(self, profile: 'RequestProfile', name: str,
+                 desc: str | None = None):
+        self.profile = profile
+        self.name = name
+        self.desc = desc
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.profile.add(self.name, self.desc, self.start,
+                         time.perf_counter())
+
+
+def span(name: str, desc: str | None = None):
+    # Time a block of code if the current request is being profiled
+    if (profile := current.get()) is None:
+        return NO_SPAN
+    return Span(profile, name, desc)
+
+
+def propagate(fn):
+    # Run `fn` (e.g. on another thread) in the current profile, if any
+    if current.get() is None:
+        return fn
+    ctx = contextvars.copy_context()
+    return lambda *args: ctx.run(fn, *args)
+
+
+def detach(fn, label: str):
+    # Run `fn` later (e.g. as a background job) in a profile of its own,
+    # continuing the current one, which is dumped when `fn` finishes
+    if (parent := current.get()) is None:
+        return fn
+
+    def run(*args):
+        profile = RequestProfile(parent.profiler, f'{parent.id}-{label}',
+                                 parent.method, parent.path,
+                                 parent.use_cprofile)
+        profile.start()
+        token = current.set(profile)
+        try:
+            return fn(*args)
+        finally:
+            current.reset(token)
+            profile.finish()
+
+    return run
+
+
+class RequestProfile:
+    """ Spans (and possibly a cProfile) of one request """
+
+    def __init__(self, profiler: 'Profiler', profile_id: str, method: str,
+                 path: str, use_cprofile: bool = False):
+        self.profiler = profiler
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.use_cprofile = use_cprofile
+        self.cprofile = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        if self.use_cprofile and cprofile_lock.acquire(blocking=False):
+            self.cprofile = cProfile.Profile()
+            try:
+                self.cprofile.enable()
+            except ValueError:
+                # Another profiler (e.g. a debugger) is active
+                self.cprofile = None
+                cprofile_lock.release()
+
+    def add(self, name: str, desc: str | None, start: float,
+            end: float) -> None:
+        with self.lock:
+            self.spans.append((name, desc, start, end,
+                               threading.current_thread().name))
+
+    def server_timing(self) -> str:
+        # Total duration of each span name so far, in milliseconds
+        with self.lock:
+            totals = {}
+            for name, _, start, end, _ in self.spans:
+                totals[name] = totals.get(name, 0.0) + end - start
+        elapsed = time.perf_counter() - self.origin
+
+        metrics = [f'{name};dur={1000 * t:.2f}' for name, t in totals.items()]
+        metrics.append(f'total;dur={1000 * elapsed:.2f}')
+        metrics.append(f'profile;desc="{self.id}"')
+        return ', '.join(metrics)
+
+    def finish(self) -> None:
+        # Stop profiling and write the dumps
+        elapsed = time.perf_counter() - self.origin
+        if self.cprofile is not None:
+            self.cprofile.disable()
+            cprofile_lock.release()
+
+        with self.lock:
+            spans = [
+                {
+                    'name': name,
+                    'desc': desc,
+                    'start_ms': round(1000 * (start - self.origin), 3),
+                    'dur_ms': round(1000 * (end - start), 3),
+                    'thread': thread,
+                }
+                for name, desc, start, end, thread in self.spans
+            ]
+        timeline = {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'started': self.started,
+            'total_ms': round(1000 * elapsed, 3),
+            'spans': spans,
+        }
+        self.profiler.dump(self, timeline)
+
+
+class Profiler:
+    """
+        Decides which requests to profile and keeps the newest `keep` dumps
+        in `profile_dir`
+    """
+
+    def __init__(self,
+                 profile_dir: str = 'profiles',
+                 sample_rate: float = 0.0,
+                 allow_header: bool = False,
+                 keep: int = 100):
+        self.profile_dir = profile_dir
+        self.sample_rate = sample_rate
+        self.allow_header = allow_header
+        self.keep = keep
+        self.lock = threading.Lock()
+
+    def start(self, handler) -> RequestProfile | None:
+        # Returns the started profile of the handler's request, if profiled
+        mode = None
+        if self.allow_header:
+            mode = handler.headers.get(PROFILE_HEADER)
+        if mode is None:
+            if not self.sample_rate or random.random() >= self.sample_rate:
+                return None
+            mode = 'spans'
+
+        profile_id = f'{time.strftime("%Y%m%d-%H%M%S")}-{os.urandom(4).hex()}'
+        profile = RequestProfile(self, profile_id, handler.command,
+                                 handler.path, mode.lower() == 'cprofile')
+        profile.start()
+        return profile
+
+    def dump(self, profile: RequestProfile, timeline: dict) -> None:
+        try:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, profile.id)
+            with open(f'{path}.json', 'w') as f:
+                json.dump(timeline, f, indent=1)
+            if profile.cprofile is not None:
+                profile.cprofile.dump_stats(f'{path}.prof')
+            self.rotate()
+        except OSError as e:
+            print(f'Failed to write profile {profile.id}: {e}')
+
+    def rotate(self) -> None:
+        # Dumps are named by time, so the oldest sort first
+        with self.lock:
+            names = sorted(os.listdir(self.profile_dir))
+            ids = sorted({name.rpartition('.')[0] for name in names})
+            expired = set(ids[:max(0, len(ids) - self.keep)])
+            for name in names:
+                if name.rpartition('.')[0] in expired:
+                    os.remove(os.path.join(self.profile_dir, name))
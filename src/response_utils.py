@@ -6,6 +6,9 @@ import os
 import json
 from http.server import BaseHTTPRequestHandler
 from http.client import HTTPMessage
+from email.utils import parsedate_to_datetime
+
+from profiling import span
 
 
 def gobble_file(filename: str, mode: str = 'r') -> bytes | str:
@@ -18,20 +21,25 @@ def gobble_file(filename: str, mode: str = 'r') -> bytes | str:
     return content
 
 
+def load_content(path: str, ctype: str, rmode: str) -> bytes:
+    # Read the content using the appropriate read mode
+    with span('file_read', path):
+        content = gobble_file(path, mode=rmode)
+    if rmode == 'r':
+        if 'json' in ctype:
+            jsond = json.loads(content)
+            jsond['status'] = 'ok'
+            content = json.dumps(jsond)
+        content = content.encode()
+    return content
+
+
 def load_and_check_content(handler: BaseHTTPRequestHandler,
                            path: str,
                            ctype: str,
                            rmode: str) -> bytes | bool:
-    # Read the content using the appropriate read mode
     try:
-        content = gobble_file(path, mode=rmode)
-        if rmode == 'r':
-            if 'json' in ctype:
-                    jsond = json.loads(content)
-                    jsond['status'] = 'ok'
-                    content = json.dumps(jsond)
-            content = content.encode()
-        return content
+        return load_content(path, ctype, rmode)
 
     except Exception:
         send_response(handler, 500,
@@ -41,12 +49,197 @@ def load_and_check_content(handler: BaseHTTPRequestHandler,
 
 def send_content(handler: BaseHTTPRequestHandler,
                  ctype: str,
-                 content: bytes) -> None:
+                 content: bytes,
+                 headers: dict[str, str] | None = None) -> None:
     handler.send_header('Content-Type', ctype)
+    handler.send_header('Content-Length', str(len(content)))
+    for k, v in (headers or {}).items():
+        handler.send_header(k, v)
     handler.end_headers()
     handler.wfile.write(content)
 
 
+def is_not_modified(headers: HTTPMessage, etag: str, mtime: int) -> bool:
+    # Evaluate the conditional request headers against the validators.
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110)
+    if (if_none_match := headers.get('If-None-Match')) is not None:
+        tags = [t.strip().removeprefix('W/') for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if (if_modified_since := headers.get('If-Modified-Since')) is not None:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return mtime <= since
+
+    return False
+
+
+def negotiate_encoding(accept_encoding: str | None,
+                       available: list[str]) -> str | None:
+    # Pick the client's most preferred of the available content codings,
+    # or None for the identity coding. Ties go to the order in `available`
+    if not accept_encoding or not available:
+        return None
+
+    prefs = {}
+    for item in accept_encoding.split(','):
+        coding, *params = item.strip().lower().split(';')
+        q = 1.0
+        for param in params:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        prefs[coding.strip()] = q
+
+    best, best_q = None, 0.0
+    for coding in available:
+        q = prefs.get(coding, prefs.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+
+    return best
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    # Returns the first and last byte of a single byte range of `size`
+    # bytes, or None if the header is to be ignored (it is malformed or
+    # asks for several ranges). Raises ValueError if it can't be satisfied
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+
+    first, sep, last = spec.strip().partition('-')
+    if not sep or not (first or last) or not (first + last).isdecimal():
+        return None
+
+    if not first:
+        # Suffix range, e.g. `bytes=-500` for the last 500 bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError('Range not satisfiable')
+        return max(0, size - int(last)), size - 1
+
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def select_range(handler: BaseHTTPRequestHandler,
+                 asset,
+                 size: int,
+                 headers: dict[str, str]) -> tuple[int, int, int] | None:
+    # Returns the status (200 or 206) and the first and last byte to send of
+    # the `size` byte body. Ranges of compressible assets are not supported.
+    # If the range can't be satisfied, a 416 is sent and None returned
+    byte_range = None
+    range_header = handler.headers.get('Range')
+    if_range = handler.headers.get('If-Range')
+
+    # The range is ignored if the client's copy (per If-Range) is outdated
+    if (range_header is not None and not asset.compressible and
+            if_range in (None, asset.etag, asset.last_modified)):
+        try:
+            byte_range = parse_range(range_header, size)
+        except ValueError:
+            handler.send_response(416)
+            handler.send_header('Content-Range', f'bytes */{size}')
+            handler.send_header('Content-Length', '0')
+            handler.end_headers()
+            return None
+
+    if byte_range is None:
+        return 200, 0, size - 1
+
+    start, end = byte_range
+    headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+    return 206, start, end
+
+
+def send_file(handler: BaseHTTPRequestHandler,
+              asset,
+              headers: dict[str, str]) -> None:
+    # Send (a range of) a file from disk. The handler's `write_file` uses
+    # sendfile where it can, so the content is not copied through Python
+    try:
+        f = open(asset.path, 'rb')
+    except OSError:
+        # e.g. an image evicted since the asset was cached
+        send_response(handler, 404, path=asset.path)
+        return
+
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        if (selected := select_range(handler, asset, size, headers)) is None:
+            return
+        status, start, end = selected
+        count = end - start + 1
+
+        handler.send_response(status)
+        handler.send_header('Content-Type', asset.ctype)
+        handler.send_header('Content-Length', str(count))
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.end_headers()
+
+        if count > 0:
+            with span('file_send', asset.path):
+                sent = handler.write_file(f, start, count)
+            if sent < count:
+                # The file was truncated, so the body is short of its
+                # Content-Length
+                handler.close_connection = True
+
+
+def send_asset(handler: BaseHTTPRequestHandler, asset) -> None:
+    # Send a cached asset, or a bodiless 304 if the client's copy is current.
+    # Compressible assets are sent in the client's preferred coding, other
+    # assets support single byte ranges. Large files are sent from disk
+    encoding = negotiate_encoding(
+        handler.headers.get('Accept-Encoding'), list(asset.encodings)
+    )
+    body, etag = asset.variant(encoding)
+
+    headers = {
+        'ETag': etag,
+        'Last-Modified': asset.last_modified,
+        'Cache-Control': 'no-cache',
+    }
+    if asset.compressible:
+        headers['Vary'] = 'Accept-Encoding'
+    else:
+        headers['Accept-Ranges'] = 'bytes'
+
+    if is_not_modified(handler.headers, etag, asset.mtime):
+        handler.send_response(304)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.end_headers()
+        return
+
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+
+    if body is None:
+        send_file(handler, asset, headers)
+        return
+
+    if (selected := select_range(handler, asset, len(body), headers)) is None:
+        return
+    status, start, end = selected
+    if status == 206:
+        body = memoryview(body)[start:end + 1]
+
+    handler.send_response(status)
+    send_content(handler, asset.ctype, body, headers)
+
+
 def send_response(handler: BaseHTTPRequestHandler,
                   status: int,
                   **kwargs) -> None:
@@ -61,22 +254,30 @@ def send_response(handler: BaseHTTPRequestHandler,
                 send_content(handler, 'text/html', content)
             return
 
-    handler.send_response(status)
-
     if status == 401:
         auth = kwargs.get('auth', 'Web 159352')
+        handler.send_response(status)
         handler.send_header('WWW-Authenticate', f'Basic realm="{auth}"')
+        handler.send_header('Content-Length', '0')
         handler.end_headers()
         return
 
-    handler.send_header('Content-Type', 'application/json')
-    handler.end_headers()
+    headers = {}
 
     if status == 200:
-        content = json.dumps(
-            {'status'  : status,
-             'message' : kwargs.get('message', 'OK')}
-        ).encode()
+        contentd = {'status'  : status,
+                    'message' : kwargs.get('message', 'OK')}
+        if (data := kwargs.get('data')):
+            contentd.update(data)
+        content = json.dumps(contentd).encode()
+    elif status == 202:
+        contentd = {'status'  : status,
+                    'message' : kwargs.get('message', 'Accepted')}
+        if (data := kwargs.get('data')):
+            contentd.update(data)
+        content = json.dumps(contentd).encode()
+        if (location := kwargs.get('location')) is not None:
+            headers['Location'] = location
     elif status == 400:
         content = json.dumps(
             {'status'  : status,
@@ -98,8 +299,16 @@ def send_response(handler: BaseHTTPRequestHandler,
             {'status'  : status,
              'message' : kwargs.get('message', 'Server error')}
         ).encode()
+    elif status == 503:
+        content = json.dumps(
+            {'status'  : status,
+             'message' : kwargs.get('message', 'Server busy, try again later')}
+        ).encode()
+        if (retry_after := kwargs.get('retry_after')) is not None:
+            headers['Retry-After'] = str(retry_after)
     else:
         raise ValueError(f"{status} response is not supported")
 
-    handler.wfile.write(content)
+    handler.send_response(status)
+    send_content(handler, 'application/json', content, headers)
 
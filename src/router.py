@@ -0,0 +1,151 @@
+"""
+Request routing. The route table is built once at startup (see
+server.make_router): exact routes, prefix routes keyed by their first path
+segment, and a manifest of the static files under the web root. Dispatching a
+request is then a dict lookup or two, without touching the filesystem, and any
+path that is not a route or in the manifest is a 404 by construction. This
+covers hidden files, server data and path traversal.
+
+The manifest is rebuilt when the mtime of one of its directories changes
+(checked at most once every `check_interval` seconds) or on refresh(), e.g.
+from a SIGHUP handler.
+"""
+
+import os
+import time
+import threading
+from typing import NamedTuple
+
+
+class StaticFile(NamedTuple):
+    """ A servable file, with its content type and read mode """
+    path: str
+    ctype: str
+    rmode: str
+
+
+class Manifest:
+    """
+        Files under `root` with an extension in `content_map`, by URL path.
+        Files named in `hidden` and directories in `hidden_dirs` (relative to
+        `root`, with a trailing slash) are left out, as are dotfiles.
+        `aliases` maps extra URL paths to files, e.g. '/' to 'index.html'
+    """
+
+    def __init__(self,
+                 content_map: dict[str, tuple[str, str]],
+                 root: str = '.',
+                 hidden: frozenset[str] = frozenset(),
+                 hidden_dirs: tuple[str, ...] = (),
+                 aliases: dict[str, str] | None = None,
+                 check_interval: float = 1.0):
+        self.content_map = content_map
+        self.root = root
+        self.hidden = hidden
+        self.hidden_dirs = tuple(hidden_dirs)
+        self.aliases = aliases or {}
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def scan(self) -> tuple[dict[str, StaticFile], dict[str, int]]:
+        # Returns the files by URL path, and the mtime of each directory
+        files, mtimes = {}, {}
+        pending = ['']
+        while pending:
+            rel_dir = pending.pop()
+            abs_dir = os.path.join(self.root, rel_dir)
+            try:
+                mtimes[abs_dir] = os.stat(abs_dir).st_mtime_ns
+                entries = list(os.scandir(abs_dir))
+            except OSError:
+                continue
+
+            for entry in entries:
+                rel_path = f'{rel_dir}{entry.name}'
+                if entry.name.startswith('.') or entry.name == '__pycache__':
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    if f'{rel_path}/' not in self.hidden_dirs:
+                        pending.append(f'{rel_path}/')
+                    continue
+
+                extn = entry.name.rpartition('.')[2]
+                if (extn not in self.content_map or rel_path in self.hidden
+                        or not entry.is_file()):
+                    continue
+                ctype, rmode = self.content_map[extn]
+                files[f'/{rel_path}'] = StaticFile(
+                    os.path.join(self.root, rel_path), ctype, rmode
+                )
+
+        for alias, rel_path in self.aliases.items():
+            if (static_file := files.get(f'/{rel_path}')) is not None:
+                files[alias] = static_file
+
+        return files, mtimes
+
+    def refresh(self) -> None:
+        files, mtimes = self.scan()
+        # Swap in the complete manifest
+        self.files, self.mtimes = files, mtimes
+        self.checked = time.monotonic()
+
+    def changed(self) -> bool:
+        for path, mtime_ns in self.mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime_ns:
+                    return True
+            except OSError:
+                return True
+        return False
+
+    def get(self, path: str) -> StaticFile | None:
+        if time.monotonic() - self.checked >= self.check_interval:
+            with self.lock:
+                if time.monotonic() - self.checked >= self.check_interval:
+                    if self.changed():
+                        self.refresh()
+                    else:
+                        self.checked = time.monotonic()
+        return self.files.get(path)
+
+
+class Router:
+    """
+        Maps a request to an action, called as `action(handler, target)`.
+        The target is the path (without its query string) of a route, or
+        the StaticFile of a path in `manifest`, which is passed to `static`
+    """
+
+    def __init__(self, manifest: Manifest, static):
+        self.manifest = manifest
+        self.static = static
+        self.exact = {}
+        self.prefixes = {}
+
+    def add(self, method: str, path: str, action) -> None:
+        self.exact[(method, path)] = action
+
+    def add_prefix(self, method: str, prefix: str, action) -> None:
+        # `prefix` is a whole first path segment, e.g. '/jobs/'
+        if not (prefix.startswith('/') and prefix.endswith('/')
+                and prefix.count('/') == 2):
+            raise ValueError(f'Prefix must be of the form /name/: {prefix}')
+        self.prefixes[(method, prefix)] = action
+
+    def resolve(self, method: str, path: str) -> tuple | None:
+        # Returns (action, target), or None if nothing matches
+        path = path.partition('?')[0]
+        if (action := self.exact.get((method, path))) is not None:
+            return action, path
+
+        if (end := path.find('/', 1)) != -1:
+            prefix = path[:end + 1]
+            if (action := self.prefixes.get((method, prefix))) is not None:
+                return action, path
+
+        if method == 'GET':
+            if (static_file := self.manifest.get(path)) is not None:
+                return self.static, static_file
+        return None
@@ -0,0 +1,301 @@
+"""
+Vectorised scoring for PsychProfiler. The weights are compiled once into a
+question x trait matrix and a trait x (jobs + movies) weight matrix, so the
+suitability of every job and psych movie is computed for any number of
+respondents in a single pass of array operations.
+
+A single compiled engine is shared by the whole process through `shared_engine`,
+which rebuilds it when weights.json changes on disk. The new engine replaces the
+old one in a single assignment, so an analysis in progress keeps the engine it
+started with and never sees a partially loaded model.
+
+Scores are bit-identical to the original per-question loop: contributions are
+accumulated in the order the questions appear in each form, the same way as
+the built-in `sum` (compensated since Python 3.12), rather than by a BLAS
+matrix product whose summation order is unspecified.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+
+import numpy as np
+
+
+TRAITS = ('O', 'C', 'E', 'A', 'N')
+
+# Each question is mapped to one of the Big Five traits
+TRAIT_MAP = {
+    'O':[3,7,11],
+    'C':[2,5,10,12,15],
+    'E':[1,8,14,16,20],
+    'A':[4,9,17,18],
+    'N':[6,13,19]
+}
+
+# Account for reversed questions
+REVERSED_QNS = [5,6,9,12,14,16,17,18]
+
+# `sum` of floats uses Neumaier compensated summation from Python 3.12
+COMPENSATED_SUM = sys.version_info >= (3, 12)
+
+
+def ordered_sum(x: np.ndarray) -> np.ndarray:
+    # Sum over axis 1 exactly as the built-in `sum` would add the
+    # elements one at a time
+    if not COMPENSATED_SUM:
+        return np.cumsum(x, axis=1)[:, -1]
+
+    total = np.zeros(x.shape[:1] + x.shape[2:])
+    c = np.zeros_like(total)
+    for i in range(x.shape[1]):
+        xi = x[:, i]
+        t = total + xi
+        c += np.where(np.abs(total) >= np.abs(xi),
+                      (total - t) + xi,
+                      (xi - t) + total)
+        total = t
+
+    # Only apply a (finite) compensation, which preserves the sign of zero
+    return np.where((c != 0) & np.isfinite(c), total + c, total)
+
+
+class ScoringEngine:
+    """ Scores psychological form data against the weights in weights.json """
+
+    def __init__(self, weights: dict, max_score: int = 5):
+        self.weights = weights
+        self.max_score = max_score
+        self.job_dict = weights['jobs']
+        self.movie_dict = weights['movies']
+        self.jobs = list(self.job_dict)
+        self.movies = list(self.movie_dict)
+
+        self.trait_map = {q: t for t, qs in TRAIT_MAP.items() for q in qs}
+        self.reversed_qns = REVERSED_QNS
+        self.questions = sorted(self.trait_map)
+        self.index = {q: i for i, q in enumerate(self.questions)}
+        self.question_keys = {f'question{q}': i for q, i in self.index.items()}
+
+        # Question x trait (one-hot) matrix
+        self.question_traits = np.zeros((len(self.questions), len(TRAITS)))
+        for q, t in self.trait_map.items():
+            self.question_traits[self.index[q], TRAITS.index(t)] = 1
+
+        self.reversed = np.isin(self.questions, REVERSED_QNS)
+
+        # Trait x (jobs + movies) weight matrix
+        outputs = ([self.job_dict[k] for k in self.jobs]
+                   + [self.movie_dict[k] for k in self.movies])
+        self.trait_weights = np.array(
+            [[o['weights'][t] for o in outputs] for t in TRAITS]
+        )
+
+        # The weight of each question for each output, and its worst
+        # case: 5 for -ve weight, 1 for +ve weight
+        qn_weights = self.question_traits @ self.trait_weights
+        self.worst_weights = np.where(qn_weights < 0,
+                                      qn_weights * 2, qn_weights * -2)
+
+        # Reversing a Likert scale value negates the shifted answer, so the
+        # reversed questions are baked in by negating their weights instead
+        # (which is exact)
+        self.question_weights = np.where(self.reversed[:, None],
+                                         -qn_weights, qn_weights)
+        self.weight_rows = self.question_weights.tolist()
+        self.worst_rows = self.worst_weights.tolist()
+
+        # Per-output weight vectors over the questions
+        n_jobs = len(self.jobs)
+        self.job_weights = dict(zip(self.jobs, self.question_weights.T))
+        self.movie_weights = dict(zip(self.movies,
+                                      self.question_weights.T[n_jobs:]))
+
+        # Worst-case totals of a complete form in question order (as
+        # submitted by the website), summed as `suitability_row` would
+        self.canonical = list(range(len(self.questions)))
+        self.canonical_min = [sum(row[o] for row in self.worst_rows)
+                              for o in range(len(self.jobs) + len(self.movies))]
+        self.canonical_max = [-m for m in self.canonical_min]
+
+    def parse(self, form_input: dict) -> list[tuple[int, int]]:
+        # Returns (question index, answer) pairs in the order in which the
+        # questions appear in the form. Answers are shifted to the range
+        # [-2,...,2]; reversed questions are handled by their weights
+        answers = []
+        for k, v in form_input.items():
+            if (i := self.question_keys.get(k)) is None:
+                if not k.startswith('question'):
+                    continue
+                # Unusual spelling, e.g. `question05`
+                q = int(k[len('question'):])
+                if q not in self.index:
+                    raise ValueError(f'Unknown question {q}')
+                i = self.index[q]
+
+            answers.append((i, int(v) - 3))
+        return answers
+
+    def suitabilities(self, answers: list[list[tuple[int, int]]]) -> np.ndarray:
+        # Given parsed answers of N respondents, returns the normalised
+        # (unclipped) score of each for every job followed by every psych
+        # movie, shape (N, jobs + movies)
+        n, n_qns = len(answers), len(self.questions)
+
+        # Questions in form order, then unanswered questions (which add
+        # nothing, so don't change the sums)
+        order = np.zeros((n, n_qns), dtype=np.intp)
+        shifted = np.zeros((n, n_qns), dtype=np.int64)
+        present = np.zeros((n, n_qns), dtype=bool)
+        for r, row in enumerate(answers):
+            answered = [i for i, _ in row]
+            missing = set(range(n_qns)).difference(answered)
+            order[r] = answered + sorted(missing)
+            shifted[r, :len(row)] = [a for _, a in row]
+            present[r, :len(row)] = True
+
+        # Weighted scores and worst cases, in form order
+        weighted = shifted[..., None] * self.question_weights[order]
+        worst = self.worst_weights[order] * present[..., None]
+
+        raw_sum = ordered_sum(weighted)
+        total_min = ordered_sum(worst)
+        total_max = -total_min  # since response range is {-2,...,2}
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.max_score * ((raw_sum - total_min) /
+                                     (total_max - total_min))
+
+    def suitability_row(self, answers: list[tuple[int, int]]) -> list[float]:
+        # As `suitabilities` for a single respondent. For one row, plain
+        # floats are faster than the array overhead
+        complete = [i for i, _ in answers] == self.canonical
+
+        scores = []
+        for o in range(len(self.jobs) + len(self.movies)):
+            raw_sum = sum(a * self.weight_rows[i][o] for i, a in answers)
+            if complete:
+                total_min = self.canonical_min[o]
+                total_max = self.canonical_max[o]
+            else:
+                total_min = sum(self.worst_rows[i][o] for i, _ in answers)
+                total_max = -total_min
+            if total_max == total_min:
+                scores.append(float('nan'))
+                continue
+            scores.append(self.max_score * ((raw_sum - total_min) /
+                                            (total_max - total_min)))
+        return scores
+
+    def clip(self, score: float) -> float:
+        # Clip to the range [0, max_score] as PsychProfiler.normalise_scores
+        if score != score:  # NaN
+            raise ValueError('Cannot normalise scores without any answers')
+        return max(0, min(float(score), self.max_score))
+
+    def profile(self, form_input: dict, scores) -> dict:
+        # Build the analysis for one respondent from their row of scores
+        job = form_input['job']
+        if job not in self.job_dict:
+            raise ValueError(f'job must be in {self.jobs}')
+
+        job_score = self.clip(scores[self.jobs.index(job)])
+
+        # All neutral responses -> every film gets max_score/2
+        # Hence, set a default: LotR ('I')
+        psych_key = 'I'
+        movie_score = self.max_score / 2
+        for k, s in zip(self.movies, scores[len(self.jobs):]):
+            s = self.clip(s)
+            if s > movie_score:
+                movie_score = s
+                psych_key = k
+
+        psych_movie = dict(self.movie_dict[psych_key])
+        psych_movie['suitability'] = movie_score
+
+        return {
+            'career': {
+                'desired': job,
+                'suitability': job_score,
+            },
+            'movies': {
+                'job': dict(self.job_dict[job]['movie']),
+                'psych': psych_movie,
+            },
+            'max_score': self.max_score,
+        }
+
+    def score(self, form_input: dict) -> dict:
+        scores = self.suitability_row(self.parse(form_input))
+        return self.profile(form_input, scores)
+
+    def score_batch(self, form_inputs: list[dict]) -> list[dict]:
+        # Analyse many forms at once, returning one result per form
+        if not form_inputs:
+            return []
+
+        scores = self.suitabilities([self.parse(f) for f in form_inputs])
+
+        return [self.profile(f, s) for f, s in zip(form_inputs, scores)]
+
+
+class SharedEngine:
+    """
+        Process-wide ScoringEngine for the weights in `path`, rebuilt when the
+        file's mtime changes (checked at most once every `check_interval`)
+    """
+
+    def __init__(self,
+                 path: str = 'weights.json',
+                 max_score: int = 5,
+                 check_interval: float = 1.0):
+        self.path = path
+        self.max_score = max_score
+        self.check_interval = check_interval
+        self.engine = None
+        self.mtime_ns = None
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def load(self) -> ScoringEngine:
+        # Stat before reading, so a write during the load is picked up by
+        # the next check
+        mtime_ns = os.stat(self.path).st_mtime_ns
+        with open(self.path, 'r') as f:
+            weights = json.load(f)
+        engine = ScoringEngine(weights, self.max_score)
+
+        # Swap in the fully built engine
+        self.engine, self.mtime_ns = engine, mtime_ns
+        return engine
+
+    def get(self) -> ScoringEngine:
+        engine = self.engine
+        now = time.monotonic()
+        if engine is not None and now - self.checked < self.check_interval:
+            return engine
+
+        with self.lock:
+            if self.engine is not engine:
+                # Reloaded by another thread while waiting
+                return self.engine
+            self.checked = now
+
+            try:
+                if (engine is not None and
+                        os.stat(self.path).st_mtime_ns == self.mtime_ns):
+                    return engine
+                return self.load()
+            except (OSError, ValueError, KeyError) as e:
+                if engine is None:
+                    raise
+                # Keep serving the last good weights, e.g. while the file
+                # is being rewritten
+                print(f'Failed to reload {self.path}: {e!r}')
+                return engine
+
+
+shared_engine = SharedEngine()
@@ -4,27 +4,168 @@ Implements a micro-framework to serve the website.
 
 import os
 import json
+import time
 import http.server
+import signal
+import socket
 import argparse
+import threading
 import urllib.parse
 from socketserver import ThreadingMixIn
 
+from analysis import ( ANALYSIS_DEADLINE, DataFetcher, PetPrefetcher,
+                       warm_movie_cache )
+from async_server import AsyncHTTPServer
 from authentication import Authenticator, AuthStatus
-from response_utils import load_and_check_content, send_content, send_response
-from server_utils import ( HIDDEN_PATHS, CONTENT_MAP, reset_ip_logs,
-                           do_submit, do_analyse )
+from cache_utils import AssetCache, FileAsset, MovieCache, ViewCache
+import fetch_utils
+from fetch_utils import configure_client, configure_image_store
+from jobs import AnalysisQueue, JOB_PATH
+from metrics import ( REGISTRY, HTTP_REQUESTS, HTTP_DURATION,
+                      CONTENT_TYPE as METRICS_CONTENT_TYPE )
+from pool_server import PooledHTTPServer, RouteLimiter
+from prefork import DrainingMixin, Supervisor, use_socket
+from profiling import Profiler, current as current_profile
+from router import Manifest, Router, StaticFile
+from scoring import shared_engine
+from sessions import SessionManager
+from response_utils import send_content, send_response, send_asset
+from server_utils import ( HIDDEN_PATHS, HIDDEN_DIRS, CONTENT_MAP,
+                           COMPRESSIBLE_TYPES, IMAGE_PATH,
+                           VIEW_PATHS, reset_ip_logs, get_user_key,
+                           route_label, do_submit, do_analyse,
+                           do_job_status )
+from storage import DEFAULT_USER, JSONStorage, SQLiteStorage
 
 
 DESC = "HTTP server."
 
+# Concurrent requests allowed per route (see RouteLimiter). Queued analyses
+# are already bounded by the AnalysisQueue, so /analyze is only limited when
+# it analyses during the request
+DEFAULT_ROUTE_LIMITS = {'/analyze': 2, '/submit': 8}
+
 
 class MyHandler(http.server.BaseHTTPRequestHandler):
+    # The headers and body of a response are separate writes, the second of
+    # which Nagle's algorithm would hold until the client's delayed ACK
+    disable_nagle_algorithm = True
+
     def __init__(self, *args, **kwargs):
         self.do_auth = kwargs.pop('do_auth', True)
         self.authenticator = kwargs.pop('authenticator')
+        self.asset_cache = kwargs.pop('asset_cache')
+        self.view_cache = kwargs.pop('view_cache', None)
+        self.router = kwargs.pop('router')
+        self.image_store = kwargs.pop('image_store')
+        self.route_limiter = kwargs.pop('route_limiter', None)
+        self.storage = kwargs.pop('storage')
+        self.analysis_deadline = kwargs.pop('analysis_deadline',
+                                            ANALYSIS_DEADLINE)
+        self.data_fetcher = kwargs.pop('data_fetcher', None)
+        self.analysis_queue = kwargs.pop('analysis_queue', None)
+        self.profiler = kwargs.pop('profiler', None)
+        self.profile = None
+        self.workers = kwargs.pop('workers', 1)
+        self.worker = kwargs.pop('worker', 0)
+
+        # Persistent connections (HTTP/1.1). `timeout` is applied to the
+        # socket by StreamRequestHandler and closes idle connections
+        if kwargs.pop('keep_alive', True):
+            self.protocol_version = 'HTTP/1.1'
+        self.timeout = kwargs.pop('idle_timeout', None)
+        self.max_requests = kwargs.pop('max_requests', 100)
+        self.n_requests = 0
+
         self.setup_actions()
         super().__init__(*args, **kwargs)
 
+    def handle_one_request(self) -> None:
+        if not self.set_idle(True) and self.n_requests > 0:
+            # Draining: don't wait for another request on this connection
+            self.close_connection = True
+            return
+
+        self.n_requests += 1
+        self.connection_header_sent = False
+        self.auth_user = None
+        self.session_id = None
+        self.session_cookie = None
+        self.command = None
+        self.status_code = None
+        self.parsed = False
+        try:
+            super().handle_one_request()
+        finally:
+            if self.profile is not None:
+                current_profile.reset(self.profile_token)
+                self.profile.finish()
+                self.profile = None
+
+        # Only requests that were parsed are recorded, not e.g. an idle
+        # keep-alive timeout or a request line rejected with 414
+        if self.parsed and self.status_code is not None:
+            route = route_label(self.path)
+            HTTP_REQUESTS.inc(self.command, route, self.status_code)
+            HTTP_DURATION.observe(time.perf_counter() - self.started,
+                                  self.command, route)
+
+    def parse_request(self) -> bool:
+        # Time requests from their request line, not from waiting for it
+        self.started = time.perf_counter()
+        self.set_idle(False)
+        if not super().parse_request():
+            return False
+        self.parsed = True
+
+        if self.profiler is not None:
+            self.profile = self.profiler.start(self)
+            if self.profile is not None:
+                self.profile_token = current_profile.set(self.profile)
+        return True
+
+    def send_response(self, code: int, message: str | None = None) -> None:
+        self.status_code = code
+        super().send_response(code, message)
+
+    def send_header(self, keyword: str, value: str) -> None:
+        if keyword.lower() == 'connection':
+            self.connection_header_sent = True
+        super().send_header(keyword, value)
+
+    def end_headers(self) -> None:
+        # Tell HTTP/1.1 clients when the connection will not be reused
+        if (self.protocol_version == 'HTTP/1.1'
+                and not self.connection_header_sent):
+            if (self.n_requests >= self.max_requests
+                    or getattr(self.server, 'saturated', False)
+                    or getattr(self.server, 'draining', False)):
+                self.close_connection = True
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+        if self.session_cookie is not None:
+            # Issued by the Authenticator on successful Basic authentication
+            self.send_header('Set-Cookie', self.session_cookie)
+        if self.profile is not None:
+            self.send_header('Server-Timing', self.profile.server_timing())
+        super().end_headers()
+
+    def set_idle(self, idle: bool) -> bool:
+        # Lets a draining server close the connection while it waits for
+        # the next request (see prefork.DrainingMixin)
+        if (set_idle := getattr(self.server, 'set_idle', None)) is None:
+            return True
+        return set_idle(self.connection, idle)
+
+    def finish(self) -> None:
+        self.set_idle(False)
+        super().finish()
+
+    def write_file(self, f, offset: int, count: int) -> int:
+        # Send part of an open file straight from the page cache to the
+        # socket (os.sendfile), returning the bytes sent
+        return self.connection.sendfile(f, offset, count)
+
     def setup_actions(self) -> None:
         if hasattr(self, 'headers'):
             if ('User-Agent' in self.headers):
@@ -46,54 +187,147 @@ class MyHandler(http.server.BaseHTTPRequestHandler):
         }
 
     def handle_get(self) -> None:
-        path_map = {
-            '/': 'index.html',
-            '/form': 'psycho.html',
-            '/view/input': 'data/input.json',
-            '/view/profile': 'data/profile.json',
-        }
-        path = path_map.get(self.path, self.path.lstrip('/'))
-        extn = path.split('.')[-1]
+        if (route := self.router.resolve('GET', self.path)) is None:
+            self.send_not_found()
+            return
+        action, target = route
+        action(self, target)
 
-        if path in HIDDEN_PATHS:
+    def send_not_found(self) -> None:
+        path = self.path.partition('?')[0].lstrip('/')
+        if path in HIDDEN_PATHS or path.startswith(HIDDEN_DIRS):
             # User tried to access hidden files
             print('Warning: attempt to access hidden server files')
-            send_response(self, 404, beautiful=self.beautiful, path=path)
+        send_response(self, 404, beautiful=self.beautiful, path=path)
+
+    def handle_stats(self, _) -> None:
+        send_response(self, 200, message='Server statistics',
+                      data=self.get_stats())
+
+    def handle_metrics(self, _) -> None:
+        self.send_response(200)
+        send_content(self, METRICS_CONTENT_TYPE, REGISTRY.render())
+
+    def handle_static(self, static_file: StaticFile) -> None:
+        try:
+            asset = self.asset_cache.get(*static_file)
+        except Exception:
+            send_response(self, 500,
+                message="Server misconfigured! Could not send content")
             return
 
-        # File must exist and extension must be supported
-        if os.path.exists(path) and extn in CONTENT_MAP:
-            ctype, rmode = CONTENT_MAP[extn]            
-            if (content := load_and_check_content(self, path, ctype, rmode)):
-                self.send_response(200)
-                send_content(self, ctype, content)
+        if asset is not None:
+            send_asset(self, asset)
         else:
+            # Removed since the manifest was built
+            self.send_not_found()
+
+    def handle_image(self, path: str) -> None:
+        # Only images in the image store are served
+        name = path[len(IMAGE_PATH):]
+        extn = name.rpartition('.')[2]
+        if extn not in CONTENT_MAP or not self.image_store.has(name):
+            self.send_not_found()
+            return
+
+        # Always sent from disk, bypassing the asset cache, so memory stays
+        # flat however many images the store holds
+        image_path = self.image_store.path(name)
+        try:
+            st = os.stat(image_path)
+        except OSError:
+            # Evicted by another request
+            self.send_not_found()
+            return
+        send_asset(self, FileAsset(image_path, CONTENT_MAP[extn][0],
+                                   st.st_size, st.st_mtime_ns))
+
+    def handle_view(self, path: str) -> None:
+        # Serve the user's stored form input or profile, from the view
+        # cache if enabled
+        user = get_user_key(self)
+        load = (
+            (lambda: self.storage.get_input(user)) if path.endswith('input')
+            else (lambda: self.storage.get_profile(user))
+        )
+        try:
+            view = (
+                self.view_cache.get(user, path, load)
+                if self.view_cache is not None else load()
+            )
+        except Exception:
+            send_response(self, 500,
+                message="Server misconfigured! Could not send content")
+            return
+
+        if view is None:
             # Handle user error (4xx)
-            if self.path in ['/view/input', '/view/profile']:
-                task = (
-                    'submit' if self.path.endswith('input')
-                    else 'analyse'
-                )
-                send_response(self, 400,
-                    message=f'You need to {task} the form!'
-                )
-            else:
-                send_response(self, 404, beautiful=self.beautiful, path=path)
+            task = (
+                'submit' if path.endswith('input')
+                else 'analyse'
+            )
+            send_response(self, 400,
+                message=f'You need to {task} the form!'
+            )
+            return
+
+        if self.view_cache is not None:
+            # Already serialised, with its ETag and compressed variants
+            send_asset(self, view)
+            return
+
+        view['status'] = 'ok'
+        self.send_response(200)
+        send_content(self, 'application/json', json.dumps(view).encode())
 
     def handle_post(self) -> None:
-        path_map = {
-            '/submit': lambda:do_submit(self),
-            '/analyze': lambda: do_analyse(self)
-        }
-        action = path_map.get(self.path)
-        if action is None:
-            send_response(self, 404, path=path)
-        else:
-            action()
+        if (route := self.router.resolve('POST', self.path)) is None:
+            # The payload is left unread, so the connection can't be reused
+            self.close_connection = True
+            send_response(self, 404, path=self.path)
+            return
+        action, target = route
+        action(self, target)
+
+    def get_stats(self) -> dict:
+        # Of this worker only, like /metrics
+        stats = {}
+        if self.workers > 1:
+            stats['worker'] = {'index': self.worker, 'pid': os.getpid()}
+        if hasattr(self.server, 'stats'):
+            stats['pool'] = self.server.stats()
+        if self.route_limiter is not None:
+            stats['routes'] = self.route_limiter.stats()
+        if self.analysis_queue is not None:
+            stats['analysis'] = self.analysis_queue.stats()
+        if (self.data_fetcher is not None and
+                self.data_fetcher.pet_prefetcher is not None):
+            stats['pets_ready'] = self.data_fetcher.pet_prefetcher.stats()
+        return stats
 
     def do_action(self) -> None:
+        # Shed load before doing any work if the route is at its limit
+        limiter = self.route_limiter
+        route = limiter.route(self.command, self.path) if limiter else None
+
+        if limiter and not limiter.acquire(route):
+            if self.command == 'POST':
+                self.close_connection = True
+            send_response(self, 503, retry_after=limiter.retry_after)
+            return
+
+        try:
+            self.handle_action()
+        finally:
+            if limiter:
+                limiter.release(route)
+
+    def handle_action(self) -> None:
         if self.do_auth:
             status = self.authenticator.handle_auth_and_get_status(self)
+            if status != AuthStatus.SUCCESS and self.command == 'POST':
+                # As above, the payload is left unread
+                self.close_connection = True
             self.auth_actions[status]()
         else:
             self.auth_actions[AuthStatus.SUCCESS]()
@@ -109,15 +343,47 @@ class MyHandler(http.server.BaseHTTPRequestHandler):
         self.do_action()
 
 
-class ThreadedHTTPServer(ThreadingMixIn, http.server.HTTPServer):
+class ThreadedHTTPServer(DrainingMixin, ThreadingMixIn,
+                         http.server.HTTPServer):
     """Handle requests in a separate thread."""
 
+
+def make_router(manifest: Manifest) -> Router:
+    # The route table, built once at startup
+    router = Router(manifest, static=MyHandler.handle_static)
+    router.add('GET', '/stats', MyHandler.handle_stats)
+    router.add('GET', '/metrics', MyHandler.handle_metrics)
+    for path in VIEW_PATHS:
+        router.add('GET', path, MyHandler.handle_view)
+    router.add_prefix('GET', JOB_PATH, do_job_status)
+    router.add_prefix('GET', IMAGE_PATH, MyHandler.handle_image)
+    router.add('POST', '/submit', lambda handler, _: do_submit(handler))
+    router.add('POST', '/analyze', lambda handler, _: do_analyse(handler))
+    return router
+
+
+def route_limit(arg: str) -> tuple[str, int]:
+    # Parse ROUTE=N from the command line
+    route, _, n = arg.rpartition('=')
+    if not route or not n.isdigit() or int(n) < 1:
+        raise argparse.ArgumentTypeError(f'expected ROUTE=N, got `{arg}`')
+    return route, int(n)
+
+def default_route_limits(args: argparse.Namespace) -> dict[str, int]:
+    if args.analysis_workers > 0:
+        return {route: n for route, n in DEFAULT_ROUTE_LIMITS.items()
+                if route != '/analyze'}
+    return DEFAULT_ROUTE_LIMITS
+
+
 def main(args: argparse.Namespace) -> None:
     try:
         if args.reset_auth:
             reset_ip_logs()
 
-        port_msg = f"Launching server on port: {args.port}."
+        port_msg = f"Launching {args.engine} server on port: {args.port}."
+        if args.workers > 1:
+            port_msg = port_msg[:-1] + f" with {args.workers} workers."
         auth_msg = f"Authentication: {'dis' if args.disable_auth else 'en'}abled."
         ban_msg = '' if args.disable_auth else 'IP ban: ' + (
             'disabled.'if args.disable_ban
@@ -125,29 +391,253 @@ def main(args: argparse.Namespace) -> None:
         )
         print(port_msg, auth_msg, ban_msg)
 
+        if args.storage == 'json':
+            # No analysis survives a restart of the server
+            JSONStorage().release_analysis(DEFAULT_USER)
+
+        if args.workers > 1 and args.sessions:
+            # Create the signing key once, rather than in every worker
+            SessionManager(key_file=args.session_key_file,
+                           ttl=args.session_ttl,
+                           rotate_interval=args.session_rotate)
+    except Exception as e:
+        print('\nServer did not start due to the following exception:', e)
+        return
+
+    if args.workers <= 1:
+        serve(args)
+        return
+
+    # Workers are forked before any threads are started, and each runs a
+    # server of its own on the shared socket
+    supervisor = Supervisor(
+        lambda sock, index: serve(args, sock, index),
+        args.port,
+        workers=args.workers,
+        reuse_port=args.reuse_port,
+        drain_timeout=args.drain_timeout
+    )
+    try:
+        supervisor.run()
+    except OSError as e:
+        print('\nServer did not start due to the following exception:', e)
+        return
+    print('\nStopped server.')
+
+
+def serve(args: argparse.Namespace,
+          sock: socket.socket | None = None,
+          index: int = 0) -> None:
+    # Run a server on the port, or on `sock` as worker `index` of the
+    # supervisor (see prefork.py)
+    authenticator = pet_prefetcher = analysis_queue = None
+    drained = False
+    if args.workers > 1:
+        # Each worker answers /metrics with its own (see metrics.py)
+        REGISTRY.set_labels(worker=str(index))
+    try:
+        sessions = None
+        if args.sessions:
+            sessions = SessionManager(
+                key_file=args.session_key_file,
+                ttl=args.session_ttl,
+                rotate_interval=args.session_rotate
+            )
         authenticator = Authenticator(
             ban=not args.disable_ban,
-            n_attempts=args.auth_attempts
+            n_attempts=args.auth_attempts,
+            sessions=sessions,
+            shared=args.workers > 1
         )
-        webServer = ThreadedHTTPServer(
-            ('', args.port),
-            lambda *inner_args, **kwargs: MyHandler(
-                *inner_args, **kwargs,
-                do_auth=not args.disable_auth,
-                authenticator=authenticator,
+        asset_cache = AssetCache(
+            compressible_types=COMPRESSIBLE_TYPES,
+            min_compress_size=args.min_compress_size,
+            sendfile_threshold=args.sendfile_threshold or None
+        )
+        storage = (
+            SQLiteStorage(args.db_path) if args.storage == 'sqlite'
+            else JSONStorage()
+        )
+        view_cache = None
+        if args.view_cache_size > 0:
+            view_cache = ViewCache(
+                min_compress_size=args.min_compress_size,
+                max_users=args.view_cache_size,
+                version=storage.version if args.workers > 1 else None
             )
+            storage.add_listener(view_cache.invalidate)
+
+        configure_client(
+            pool_size=args.upstream_pool_size,
+            connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout,
+            retries=args.upstream_retries
         )
-        webServer.serve_forever()
+        configure_image_store(max_bytes=args.image_budget * 1024 * 1024)
+
+        # Static files are served from the manifest, images from the store
+        image_store = fetch_utils.image_store
+        manifest = Manifest(
+            CONTENT_MAP,
+            hidden=HIDDEN_PATHS,
+            hidden_dirs=(*HIDDEN_DIRS, f'{image_store.image_dir}/',
+                         f'{args.profile_dir.rstrip("/")}/'),
+            aliases={'/': 'index.html', '/form': 'psycho.html'}
+        )
+        router = make_router(manifest)
+        if hasattr(signal, 'SIGHUP'):
+            # Rescan the web root and reload the static files
+            def reload_static(*_) -> None:
+                manifest.refresh()
+                asset_cache.clear()
+                print(f'Reloaded {len(manifest.files)} static files.')
+            signal.signal(signal.SIGHUP, reload_static)
+
+        # Compile the weights up front rather than on the first analysis
+        shared_engine.get()
+
+        # Movie data and pet images are fetched ahead of the analyses
+        movie_cache = None
+        if args.movie_cache_ttl > 0:
+            movie_cache = MovieCache(args.movie_cache_file,
+                                     args.movie_cache_ttl)
+        if args.pet_prefetch > 0:
+            pet_prefetcher = PetPrefetcher(args.pet_prefetch)
+        data_fetcher = DataFetcher(movie_cache, pet_prefetcher)
+
+        profiler = None
+        if args.profile_sample_rate > 0 or args.profile_header:
+            profiler = Profiler(
+                profile_dir=args.profile_dir,
+                sample_rate=args.profile_sample_rate,
+                allow_header=args.profile_header,
+                keep=args.profile_keep
+            )
+
+        if args.analysis_workers > 0:
+            analysis_queue = AnalysisQueue(
+                workers=args.analysis_workers,
+                queue_size=args.analysis_queue_size,
+                retry_after=args.retry_after
+            )
+
+        # Workers share the cache file, so only the first one warms it up
+        if (movie_cache is not None and not args.disable_warm_up
+                and index == 0):
+            threading.Thread(target=warm_movie_cache,
+                             args=(data_fetcher,),
+                             name='warm-up', daemon=True).start()
+
+        handler_kwargs = {
+            'do_auth': not args.disable_auth,
+            'authenticator': authenticator,
+            'asset_cache': asset_cache,
+            'view_cache': view_cache,
+            'router': router,
+            'image_store': image_store,
+            'storage': storage,
+            'keep_alive': not args.disable_keep_alive,
+            'idle_timeout': args.idle_timeout,
+            'max_requests': args.max_requests,
+            'analysis_deadline': args.analysis_deadline,
+            'data_fetcher': data_fetcher,
+            'analysis_queue': analysis_queue,
+            'profiler': profiler,
+            'workers': args.workers,
+            'worker': index,
+            'route_limiter': RouteLimiter(
+                dict(args.route_limit or default_route_limits(args)),
+                retry_after=args.retry_after
+            ),
+        }
+        if args.engine == 'asyncio':
+            webServer = AsyncHTTPServer(
+                MyHandler, handler_kwargs, workers=args.async_workers
+            )
+        else:
+            handler = lambda *inner_args, **kwargs: MyHandler(
+                *inner_args, **kwargs, **handler_kwargs
+            )
+            if args.engine == 'pool':
+                webServer = PooledHTTPServer(
+                    ('', args.port),
+                    handler,
+                    workers=args.pool_size,
+                    queue_size=args.queue_size,
+                    retry_after=args.retry_after,
+                    bind_and_activate=sock is None
+                )
+            else:
+                webServer = ThreadedHTTPServer(('', args.port), handler,
+                                               bind_and_activate=sock is None)
+            if sock is not None:
+                use_socket(webServer, sock)
+
+        # Drain on SIGTERM: stop accepting and let the requests (and queued
+        # analyses) in progress finish
+        signal.signal(signal.SIGTERM, lambda *_: webServer.drain())
+        if args.engine == 'asyncio':
+            webServer.serve_forever(args.port, sock)
+        else:
+            webServer.serve_forever()
+            # Returns once draining. Wait for the connections in progress
+            webServer.server_close()
+        drained = True
     except KeyboardInterrupt:
         print('\nStopped server.')
     except Exception as e:
         print('\nServer did not start due to the following exception:', e)
+    finally:
+        if authenticator is not None:
+            # Persist any pending auth attempts
+            authenticator.close()
+        if pet_prefetcher is not None:
+            pet_prefetcher.close()
+        if analysis_queue is not None:
+            analysis_queue.close()
+            if drained:
+                analysis_queue.join(args.drain_timeout)
+        if drained:
+            print('Drained server.')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=DESC)
     parser.add_argument('-p', '--port', type=int, default=8080,
                         help='port to listen on (default 8080)')
+    parser.add_argument('-e', '--engine',
+                        choices=['threaded', 'pool', 'asyncio'],
+                        default='threaded',
+                        help='`threaded` (one thread per connection), `pool` '
+                             '(fixed worker threads) or `asyncio` (event '
+                             'loop) (default threaded)')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='server processes accepting on the port, each '
+                             'with its own engine and caches. /metrics and '
+                             '/stats answer for one worker, labelled '
+                             '`worker` (default 1)')
+    parser.add_argument('--reuse-port', action='store_true', default=False,
+                        help='with `--workers`, give each worker a socket of '
+                             'its own (SO_REUSEPORT) rather than sharing one')
+    parser.add_argument('--drain-timeout', type=float, default=30,
+                        help='seconds allowed on SIGTERM for requests and '
+                             'queued analyses to finish (default 30)')
+    parser.add_argument('--pool-size', type=int, default=32,
+                        help='worker threads with `--engine pool` (default 32)')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='connections waiting for a worker with `--engine '
+                             'pool` before sending 503 (default 64)')
+    parser.add_argument('--route-limit', type=route_limit, action='append',
+                        metavar='ROUTE=N',
+                        help='concurrent requests allowed on a path or method '
+                             '(e.g. /analyze=2 or GET=64) before sending 503. '
+                             'Repeatable (default /submit=8, and /analyze=2 '
+                             'with `--analysis-workers 0`)')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After seconds sent with 503 (default 1)')
+    parser.add_argument('--async-workers', type=int, default=16,
+                        help='threads for POST requests with `--engine '
+                             'asyncio` (default 16)')
     parser.add_argument('-a', '--auth-attempts', type=int, default=3,
                         help='maximum authentication attempts (default 3)')
     parser.add_argument('--disable-ban', action='store_true', default=False,
@@ -156,6 +646,96 @@ if __name__ == '__main__':
                         help='disable IP logging and blacklisting')
     parser.add_argument('--reset-auth', action='store_true', default=False,
                         help='reset IP logs and blacklist')
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json',
+                        help='`json` (one form shared by all users in data/) '
+                             'or `sqlite` (one form per user/session) '
+                             '(default json)')
+    parser.add_argument('--db-path', default=os.path.join('data', 'psych.db'),
+                        help='SQLite database with `--storage sqlite` '
+                             '(default data/psych.db)')
+    parser.add_argument('--sessions', action='store_true', default=False,
+                        help='issue signed session cookies after successful '
+                             'authentication')
+    parser.add_argument('--session-ttl', type=int, default=3600,
+                        help='session cookie lifetime in seconds (default 3600)')
+    parser.add_argument('--session-rotate', type=int, default=86400,
+                        help='seconds between session signing key rotations '
+                             '(default 86400)')
+    parser.add_argument('--session-key-file', default='session.key',
+                        help='file holding the session signing keys '
+                             '(default session.key)')
+    parser.add_argument('--min-compress-size', type=int, default=1024,
+                        help='smallest text asset (bytes) to send gzip/deflate '
+                             'compressed (default 1024)')
+    parser.add_argument('--sendfile-threshold', type=int,
+                        default=256 * 1024,
+                        help='smallest binary static file (bytes) sent '
+                             'from disk with sendfile rather than cached in '
+                             'memory, 0 to cache all files. Downloaded images '
+                             'are always sent from disk. With `--engine '
+                             'asyncio` the event loop streams them '
+                             '(loop.sendfile) (default 262144)')
+    parser.add_argument('--view-cache-size', type=int, default=1024,
+                        help='users whose serialised /view responses are '
+                             'kept in memory, 0 to disable (default 1024)')
+    parser.add_argument('--disable-keep-alive', action='store_true',
+                        default=False,
+                        help='close the connection after every response '
+                             '(HTTP/1.0)')
+    parser.add_argument('--idle-timeout', type=float, default=15,
+                        help='seconds before an idle connection is closed '
+                             '(default 15)')
+    parser.add_argument('--max-requests', type=int, default=100,
+                        help='maximum requests per connection (default 100)')
+    parser.add_argument('--analysis-deadline', type=float,
+                        default=ANALYSIS_DEADLINE,
+                        help='seconds allowed for the upstream fetches of one '
+                             'analysis, after which missing pieces are left '
+                             'out of the profile (default 20)')
+    parser.add_argument('--movie-cache-file',
+                        default=os.path.join('cache', 'omdb.json'),
+                        help='file caching OMDb movie data '
+                             '(default cache/omdb.json)')
+    parser.add_argument('--movie-cache-ttl', type=float, default=7 * 86400,
+                        help='seconds before cached movie data is refetched, '
+                             '0 to disable the cache (default 604800)')
+    parser.add_argument('--disable-warm-up', action='store_true',
+                        default=False,
+                        help='do not prefetch every movie and poster into '
+                             'the movie cache at startup')
+    parser.add_argument('--upstream-pool-size', type=int, default=16,
+                        help='kept-alive connections per upstream host '
+                             '(default 16)')
+    parser.add_argument('--connect-timeout', type=float, default=3.05,
+                        help='seconds to connect to an upstream API '
+                             '(default 3.05)')
+    parser.add_argument('--read-timeout', type=float, default=10,
+                        help='seconds to wait for upstream data (default 10)')
+    parser.add_argument('--upstream-retries', type=int, default=2,
+                        help='retries of a failed upstream GET, with jittered '
+                             'backoff (default 2)')
+    parser.add_argument('--image-budget', type=int, default=256,
+                        help='MiB of downloaded posters and pet images to keep, '
+                             'evicting the least recently used (default 256)')
+    parser.add_argument('--pet-prefetch', type=int, default=3,
+                        help='downloaded images to keep ready for each pet, '
+                             '0 to fetch during analysis (default 3)')
+    parser.add_argument('--analysis-workers', type=int, default=2,
+                        help='threads running queued analyses, 0 to analyse '
+                             'during the /analyze request (default 2)')
+    parser.add_argument('--analysis-queue-size', type=int, default=16,
+                        help='analyses waiting for a worker before /analyze '
+                             'sends 503 (default 16)')
+    parser.add_argument('--profile-sample-rate', type=float, default=0,
+                        help='fraction of requests to profile (default 0)')
+    parser.add_argument('--profile-header', action='store_true',
+                        default=False,
+                        help='profile requests sent with an `X-Profile: spans` '
+                             'or `X-Profile: cprofile` header')
+    parser.add_argument('--profile-dir', default='profiles',
+                        help='directory for profile dumps (default profiles)')
+    parser.add_argument('--profile-keep', type=int, default=100,
+                        help='profile dumps to keep (default 100)')
     args = parser.parse_args()
 
     main(args)
@@ -8,15 +8,40 @@ from http.server import BaseHTTPRequestHandler
 from http.client import HTTPMessage
 
 from analysis import analyse
+from jobs import JOB_PATH, new_job_id
+from profiling import detach
 from response_utils import send_response
+from storage import DEFAULT_USER
 
 
-# Define hidden paths for security
-HIDDEN_PATHS = [
-    'analysis.py', 'auth.json', 'authentication.py', 'default_input.json'
+# Define hidden paths for security. Only files in the manifest (see
+# router.py) are served, which leaves these out
+HIDDEN_PATHS = frozenset({
+    'analysis.py', 'auth.json', 'authentication.py', 'default_input.json',
     'Dockerfile', 'fetch_utils.py', 'requirements.txt', 'reset_blacklist.py',
-    'response_utils.py', 'server.py', 'server_utils.py', 'weights.json'
-]
+    'response_utils.py', 'server.py', 'server_utils.py', 'weights.json',
+    'cache_utils.py', 'async_server.py', 'pool_server.py', 'sessions.py',
+    'session.key', 'storage.py', 'scoring.py', 'batch_score.py',
+    'cache/omdb.json', 'images/index.json', 'jobs.py', 'metrics.py',
+    'profiling.py', 'router.py', 'prefork.py'
+})
+
+
+# Directories of server-generated files and user data, also hidden
+HIDDEN_DIRS = ('cache/', 'profiles/', 'data/')
+
+
+# URIs serving user data, which is written between requests
+VIEW_PATHS = ['/view/input', '/view/profile']
+
+
+# Path prefix of the downloaded posters and pet images
+IMAGE_PATH = '/images/'
+
+
+# Routes with their own metrics. Other paths are grouped (see route_label)
+ROUTES = {'/', '/form', '/submit', '/analyze', '/stats', '/metrics',
+          *VIEW_PATHS}
 
 
 # Dictionary of content types and file i/o modes according to file
@@ -30,10 +55,17 @@ CONTENT_MAP = {
     'jpeg' : ('image/jpeg', 'rb'),
     'png'  : ('image/png', 'rb'),
     'gif'  : ('image/gif', 'rb'),
+    'pdf'  : ('application/pdf', 'rb'),
     'json' : ('application/json', 'r')
 }
 
 
+# Content types worth compressing. The image formats are already compressed
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/javascript', 'text/css', 'application/json'
+}
+
+
 # Resets the IP logs/blacklist
 def reset_ip_logs() -> None:
     if not os.path.exists(auth_file := 'auth.json'):
@@ -54,6 +86,31 @@ def reset_ip_logs() -> None:
         json.dump(auth_json, fout)
 
 
+def route_label(path: str) -> str:
+    # A bounded set of labels for metrics: known routes, job status,
+    # images, other static files, or anything else
+    path = path.partition('?')[0]
+    if path in ROUTES:
+        return path
+    if path.startswith(JOB_PATH):
+        return f'{JOB_PATH}<id>'
+    if path.startswith(IMAGE_PATH):
+        return f'{IMAGE_PATH}<file>'
+    if path.rpartition('.')[2] in CONTENT_MAP:
+        return '<static>'
+    return '<other>'
+
+
+# Key under which the user's data is stored: their session if they
+# have one, else their username (everyone shares one form without auth)
+def get_user_key(handler: BaseHTTPRequestHandler) -> str:
+    return (
+        getattr(handler, 'session_id', None)
+        or getattr(handler, 'auth_user', None)
+        or DEFAULT_USER
+    )
+
+
 # Load serialised JSON string into a Python data structure
 def load_json(json_str: str):
     try:
@@ -83,6 +140,24 @@ def parse_payload_str(headers: HTTPMessage, post_str: str):
         return False
 
 
+def load_defaults(default_path: str = 'default_input.json') -> dict:
+    if not os.path.exists(default_path):
+        print(f"Warning: `{default_path}` not found, "
+              f"unable to copy default inputs if needed")
+
+    with open(default_path, 'r') as f:
+        return json.load(f)
+
+
+def fill_defaults(data: dict, default: dict) -> dict:
+    # Add any inputs missing from `data`, after those it has (the order of
+    # the questions is kept)
+    for k in default:
+        if k not in data:
+            data[k] = default[k]
+    return data
+
+
 # Logic for /submit
 def do_submit(handler: BaseHTTPRequestHandler) -> None:
     post_str = get_payload_str(handler)
@@ -95,37 +170,19 @@ def do_submit(handler: BaseHTTPRequestHandler) -> None:
 
     if data == 'repeat':
         # 'Submit' before 'View Form'
-        data_path = os.path.join('data', 'input.json')
         message = (
-            'Form already submitted!' if os.path.exists(data_path)
+            'Form already submitted!'
+            if handler.storage.get_state(get_user_key(handler)) is not None
             else 'You need to fill in the form!'
         )
         send_response(handler, 400, message=message)
         return
 
     # Fill any missing inputs (possible with curl/wget)
-    default_path = 'default_input.json'
-
-    if not os.path.exists(default_path):
-        print(f"Warning: `{default_path}` not found, "
-              f"unable to copy default inputs if needed")
-
-    with open(default_path, 'r') as f:
-        default = json.load(f)
+    fill_defaults(data, load_defaults())
 
-    for k in default:
-        if k not in data:
-            data[k] = default[k]
-
-    # Save responses
-    os.makedirs('data', exist_ok=True)
-
-    with open(os.path.join('data', 'input.json'), 'w') as fout:
-        json.dump(data, fout)
-
-    # Ensure no old analysis
-    if os.path.exists(old_path := os.path.join('data', 'profile.json')):
-        os.remove(old_path)
+    # Save responses, discarding any old analysis
+    handler.storage.save_input(get_user_key(handler), data)
 
     send_response(handler, 200, message='Form responses saved!')
 
@@ -140,19 +197,43 @@ def do_analyse(handler: BaseHTTPRequestHandler) -> None:
             message='Unexpected payload for /analyze URI')
         return
 
-    data_path = os.path.join('data', 'input.json')
+    user = get_user_key(handler)
 
-    if os.path.exists(data_path):
-        # Check for analysed tag
-        with open(data_path, 'r') as f:
-            if json.load(f).get('analysed'):
-                send_response(handler, 400, message='Form already analysed!')
-                return
-    else:
+    # A queued job is recorded with the claim, so that every server process
+    # can tell how it went
+    job_id = new_job_id() if handler.analysis_queue is not None else None
+    state, form_input = handler.storage.claim_analysis(user, job_id)
+
+    if state is None:
         send_response(handler, 400, message='You need to submit the form!')
         return
+    if state == 'analysing':
+        send_response(handler, 400, message='Form is already being analysed!')
+        return
+    if state == 'analysed':
+        send_response(handler, 400, message='Form already analysed!')
+        return
+
+    task = lambda: analyse(form_input, handler.storage, user,
+                           deadline=handler.analysis_deadline,
+                           data_fetcher=handler.data_fetcher)
+
+    if handler.analysis_queue is not None:
+        # Analyse in the background; the client polls the job. If this
+        # request is profiled, so is the job
+        task = detach(task, 'analysis')
+        if (job := handler.analysis_queue.submit(user, task, job_id)) is None:
+            handler.storage.release_analysis(user)
+            send_response(handler, 503, message='Too many analyses queued',
+                          retry_after=handler.analysis_queue.retry_after)
+            return
+
+        send_response(handler, 202, message='Analysis queued',
+                      location=f'{JOB_PATH}{job.id}', data=job.status())
+        return
+
     try:
-        analyse()
+        task()
     except Exception as e:
         print(f'Error during analysis: {e}')
         send_response(handler, 500,
@@ -161,3 +242,46 @@ def do_analyse(handler: BaseHTTPRequestHandler) -> None:
 
     send_response(handler, 200, message='Profile successfully created!')
 
+
+# Messages for each state of an analysis job
+JOB_MESSAGES = {
+    'queued': 'Analysis queued',
+    'running': 'Analysing...',
+    'done': 'Profile successfully created!',
+    'failed': 'Server is misconfigured! There was an error during analysis',
+}
+
+
+# Job state of an analysis queued by another worker, by the state of the
+# form it claimed. A form back at `submitted` had its analysis fail
+STORED_JOB_STATES = {
+    'analysing': 'running',
+    'analysed': 'done',
+    'submitted': 'failed',
+}
+
+
+# Logic for /jobs/<id>, given the path without its query string
+def do_job_status(handler: BaseHTTPRequestHandler, path: str) -> None:
+    job_id = path[len(JOB_PATH):]
+    queue = handler.analysis_queue
+    job = queue.get(job_id) if queue is not None else None
+
+    if job is None and handler.workers > 1:
+        # Possibly queued by another worker process. If it still holds the
+        # user's stored form, the form tells how the analysis is going
+        state = STORED_JOB_STATES.get(
+            handler.storage.get_job_state(get_user_key(handler), job_id)
+        )
+        if state is not None:
+            send_response(handler, 200, message=JOB_MESSAGES[state],
+                          data={'job': job_id, 'state': state})
+            return
+
+    # Jobs are private to the user who queued them
+    if job is None or job.user != get_user_key(handler):
+        send_response(handler, 404, message='Unknown job', path=path)
+        return
+
+    send_response(handler, 200, message=JOB_MESSAGES[job.state],
+                  data=job.status())
@@ -0,0 +1,157 @@
+"""
+Signed session cookies. After a successful Basic authentication the client is
+issued an expiring cookie signed with HMAC-SHA256, so later requests are
+verified with a single MAC check instead of decoding and hashing credentials.
+Signing keys are kept in a key file (shared by every server process) and
+rotated periodically; retired keys remain valid until their cookies expire.
+"""
+
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+import threading
+from typing import NamedTuple
+from http.cookies import SimpleCookie, CookieError
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class Session(NamedTuple):
+    user: str
+    sid: str
+    expires: int
+
+
+class SessionManager:
+    """ Issues and verifies HMAC-signed session cookies """
+
+    cookie_name = 'psych_session'
+
+    def __init__(self,
+                 key_file: str = 'session.key',
+                 ttl: int = 3600,
+                 rotate_interval: int = 86400):
+        self.key_file = key_file
+        self.ttl = ttl
+        self.rotate_interval = rotate_interval
+        self.lock = threading.Lock()
+        self.loaded = time.monotonic()
+        self.keys = self.load_keys()
+        if not self.keys:
+            self.rotate()
+
+    def load_keys(self) -> list[dict]:
+        # Keys are stored newest first as {'kid', 'key', 'created'}
+        try:
+            with open(self.key_file, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+
+    def save_keys(self) -> None:
+        tmp_path = f'{self.key_file}.{os.getpid()}.tmp'
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0o600), 'w') as f:
+            json.dump(self.keys, f)
+        os.replace(tmp_path, self.key_file)
+
+    def rotate(self) -> None:
+        # Sign with a new key, keeping older keys only while cookies signed
+        # with them may still be valid
+        now = time.time()
+        with self.lock:
+            keys = self.load_keys() or self.keys
+            if keys and now - keys[0]['created'] < self.rotate_interval:
+                # Already rotated by another server process
+                self.keys = keys
+                return
+
+            key = {
+                'kid': secrets.token_hex(4),
+                'key': secrets.token_hex(32),
+                'created': now,
+            }
+            self.keys = [key] + [
+                k for k in keys
+                if now - k['created'] < self.rotate_interval + self.ttl
+            ]
+            self.save_keys()
+
+    def get_key(self, kid: str) -> bytes | None:
+        for k in self.keys:
+            if k['kid'] == kid:
+                return bytes.fromhex(k['key'])
+        return None
+
+    def sign(self, key: bytes, payload: str) -> str:
+        return b64encode(
+            hmac.new(key, payload.encode(), hashlib.sha256).digest()
+        )
+
+    def new_sid(self) -> str:
+        return secrets.token_urlsafe(12)
+
+    def issue(self, user: str, sid: str | None = None) -> str:
+        # Returns a Set-Cookie header value for `user`. Pass the `sid` of an
+        # existing session to renew it
+        if time.time() - self.keys[0]['created'] >= self.rotate_interval:
+            self.rotate()
+
+        current = self.keys[0]
+        sid = sid or self.new_sid()
+        expires = int(time.time()) + self.ttl
+        payload = (f"{current['kid']}.{b64encode(user.encode())}.{sid}."
+                   f"{expires}")
+        value = f"{payload}.{self.sign(bytes.fromhex(current['key']), payload)}"
+
+        return (f'{self.cookie_name}={value}; Max-Age={self.ttl}; Path=/; '
+                'HttpOnly; SameSite=Strict')
+
+    def needs_renewal(self, session: Session) -> bool:
+        # Sliding expiry: renew once half of the lifetime has passed
+        return session.expires - time.time() < self.ttl / 2
+
+    def verify(self, cookie_header: str | None) -> Session | None:
+        # Returns the session, or None if there is no valid session
+        if not cookie_header or self.cookie_name not in cookie_header:
+            return None
+
+        try:
+            morsel = SimpleCookie(cookie_header).get(self.cookie_name)
+            kid, user, sid, expires, signature = morsel.value.split('.')
+        except (CookieError, AttributeError, ValueError):
+            return None
+
+        if (key := self.get_key(kid)) is None:
+            # Possibly rotated by another server process. Re-read the key
+            # file at most once a second
+            if time.monotonic() - self.loaded < 1:
+                return None
+            with self.lock:
+                self.loaded = time.monotonic()
+                self.keys = self.load_keys() or self.keys
+            if (key := self.get_key(kid)) is None:
+                return None
+
+        payload = f'{kid}.{user}.{sid}.{expires}'
+        if not hmac.compare_digest(signature.encode(),
+                                   self.sign(key, payload).encode()):
+            return None
+
+        if not expires.isdigit() or int(expires) < time.time():
+            return None
+
+        try:
+            return Session(b64decode(user).decode(), sid, int(expires))
+        except ValueError:
+            return None
@@ -0,0 +1,369 @@
+"""
+Storage for each user's form input and generated profile. Every backend tracks
+the state of a user's form, which moves from `submitted` through `analysing`
+(claimed by exactly one analysis) to `analysed`.
+
+JSONStorage keeps the original behaviour of a single data/input.json and
+data/profile.json shared by everyone. Its analysis claim is a marker file, so
+like the database it holds across server processes (see prefork.py).
+SQLiteStorage keeps one row per user (or session) in a WAL-mode database, so
+concurrent users don't overwrite each other.
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from prefork import file_lock
+from profiling import span
+
+
+DEFAULT_USER = 'default'
+
+# An analysis still claimed after this many seconds is assumed to have died
+ANALYSIS_TIMEOUT = 600
+
+# The state of a form, and its input if claimed (see claim_analysis)
+Claim = tuple[str | None, dict | None]
+
+
+class Storage:
+    """ Interface for the storage backends """
+
+    def __init__(self):
+        self.listeners = []
+
+    def add_listener(self, listener) -> None:
+        # Call `listener(user)` after each write of a user's input or
+        # profile, with user None if the data is shared by every user
+        self.listeners.append(listener)
+
+    def notify(self, user: str | None) -> None:
+        for listener in self.listeners:
+            listener(user)
+
+    def get_state(self, user: str) -> str | None:
+        raise NotImplementedError
+
+    def version(self, user: str):
+        # A value that changes whenever the user's input or profile is
+        # written, by this or any other server process
+        raise NotImplementedError
+
+    def get_job_state(self, user: str, job_id: str) -> str | None:
+        # The state of the user's form if `job_id` is the job that last
+        # claimed it, else None
+        raise NotImplementedError
+
+    def get_input(self, user: str) -> dict | None:
+        raise NotImplementedError
+
+    def get_profile(self, user: str) -> dict | None:
+        raise NotImplementedError
+
+    def save_input(self, user: str, form_input: dict) -> None:
+        # Save new responses, discarding any old analysis
+        raise NotImplementedError
+
+    def claim_analysis(self, user: str,
+                       job_id: str | None = None) -> Claim:
+        # Returns the state of the user's form along with its input if the
+        # caller may analyse it (state `submitted`), in which case the form
+        # is marked `analysing` by `job_id` until it is resubmitted
+        raise NotImplementedError
+
+    def release_analysis(self, user: str) -> None:
+        # Give up a claimed analysis, e.g. after an error
+        raise NotImplementedError
+
+    def save_profile(self, user: str, form_input: dict, profile: dict) -> bool:
+        # Save the profile of a claimed analysis. Returns False if the form
+        # was resubmitted in the meantime, in which case nothing is saved
+        raise NotImplementedError
+
+
+class JSONStorage(Storage):
+    """
+        A single form shared by all users, kept in `data_dir` as input.json
+        (with an `analysed` tag once analysed) and profile.json. An analysis
+        in progress is marked by an `analysing` file, and the job that last
+        claimed the form is kept in `job`
+    """
+
+    def __init__(self, data_dir: str = 'data'):
+        super().__init__()
+        self.data_dir = data_dir
+        self.input_path = os.path.join(data_dir, 'input.json')
+        self.profile_path = os.path.join(data_dir, 'profile.json')
+        self.claim_path = os.path.join(data_dir, 'analysing')
+        self.job_path = os.path.join(data_dir, 'job')
+        self.lock = threading.Lock()
+
+    def read(self, path: str) -> dict | None:
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def write(self, path: str, data: dict) -> None:
+        # Replaced atomically, so other processes never read a partial file
+        os.makedirs(self.data_dir, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with span('json_write', path):
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+
+    def claim_lock(self):
+        # Held by every process that changes the claim or the form
+        os.makedirs(self.data_dir, exist_ok=True)
+        return file_lock(f'{self.claim_path}.lock')
+
+    def claimed(self) -> bool:
+        # A claim older than ANALYSIS_TIMEOUT is assumed to have died
+        try:
+            age = time.time() - os.stat(self.claim_path).st_mtime
+        except FileNotFoundError:
+            return False
+        return age < ANALYSIS_TIMEOUT
+
+    def version(self, user: str) -> tuple:
+        # Each write replaces the file, changing its inode
+        stamps = []
+        for path in (self.input_path, self.profile_path):
+            try:
+                st = os.stat(path)
+                stamps.append((st.st_ino, st.st_mtime_ns))
+            except FileNotFoundError:
+                stamps.append(None)
+        return tuple(stamps)
+
+    def state(self) -> str | None:
+        # Called with the lock held
+        if self.claimed():
+            return 'analysing'
+        if (form_input := self.read(self.input_path)) is None:
+            return None
+        return 'analysed' if form_input.get('analysed') else 'submitted'
+
+    def get_state(self, user: str) -> str | None:
+        with self.lock:
+            return self.state()
+
+    def get_job_state(self, user: str, job_id: str) -> str | None:
+        with self.lock, self.claim_lock():
+            try:
+                with open(self.job_path, 'r') as f:
+                    claimed_by = f.read()
+            except FileNotFoundError:
+                return None
+            return self.state() if claimed_by == job_id else None
+
+    def get_input(self, user: str) -> dict | None:
+        return self.read(self.input_path)
+
+    def get_profile(self, user: str) -> dict | None:
+        return self.read(self.profile_path)
+
+    def save_input(self, user: str, form_input: dict) -> None:
+        with self.lock, self.claim_lock():
+            self.write(self.input_path, form_input)
+
+            # Ensure no old analysis. One in progress can no longer save
+            for path in (self.profile_path, self.job_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.unclaim()
+
+        # Everyone shares the form
+        self.notify(None)
+
+    def claim_analysis(self, user: str,
+                       job_id: str | None = None) -> Claim:
+        with self.lock, self.claim_lock():
+            if self.claimed():
+                return 'analysing', None
+            if (form_input := self.read(self.input_path)) is None:
+                return None, None
+            if form_input.get('analysed'):
+                return 'analysed', None
+            if job_id is not None:
+                with open(self.job_path, 'w') as f:
+                    f.write(job_id)
+            elif os.path.exists(self.job_path):
+                os.remove(self.job_path)
+            with open(self.claim_path, 'w') as f:
+                f.write(str(os.getpid()))
+            return 'submitted', form_input
+
+    def release_analysis(self, user: str) -> None:
+        with self.lock, self.claim_lock():
+            self.unclaim()
+
+    def unclaim(self) -> None:
+        # Called with the lock held
+        try:
+            os.remove(self.claim_path)
+        except FileNotFoundError:
+            pass
+
+    def save_profile(self, user: str, form_input: dict, profile: dict) -> bool:
+        with self.lock, self.claim_lock():
+            # Resubmitting drops the claim
+            if (not os.path.exists(self.claim_path)
+                    or self.read(self.input_path) != form_input):
+                return False
+
+            # Add a tag to avoid re-analysing
+            self.write(self.input_path, {**form_input, 'analysed': True})
+            self.write(self.profile_path, profile)
+            self.unclaim()
+
+        self.notify(None)
+        return True
+
+
+class SQLiteStorage(Storage):
+    """ One row per user in an SQLite database, accessed per thread """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS forms (
+            user    TEXT PRIMARY KEY,
+            input   TEXT NOT NULL,
+            profile TEXT,
+            state   TEXT NOT NULL
+                    CHECK (state IN ('submitted', 'analysing', 'analysed')),
+            updated REAL NOT NULL,
+            job     TEXT
+        ) WITHOUT ROWID
+    '''
+
+    def __init__(self, db_path: str = os.path.join('data', 'psych.db')):
+        super().__init__()
+        self.db_path = db_path
+        self.local = threading.local()
+        if (db_dir := os.path.dirname(db_path)):
+            os.makedirs(db_dir, exist_ok=True)
+        conn = self.connect()
+        conn.execute(self.SCHEMA)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(forms)')}
+        if 'job' not in columns:
+            # A database from before jobs were recorded
+            try:
+                conn.execute('ALTER TABLE forms ADD COLUMN job TEXT')
+            except sqlite3.OperationalError:
+                # Added by another server process in the meantime
+                pass
+
+    def connect(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        if (conn := getattr(self.local, 'conn', None)) is None:
+            conn = sqlite3.connect(self.db_path, timeout=10,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return conn
+
+    def fetch(self, column: str, user: str):
+        row = self.connect().execute(
+            f'SELECT {column} FROM forms WHERE user = ?', (user,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def get_state(self, user: str) -> str | None:
+        return self.fetch('state', user)
+
+    def version(self, user: str) -> float | None:
+        return self.fetch('updated', user)
+
+    def get_job_state(self, user: str, job_id: str) -> str | None:
+        row = self.connect().execute(
+            'SELECT state FROM forms WHERE user = ? AND job = ?',
+            (user, job_id)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def get_input(self, user: str) -> dict | None:
+        form_input = self.fetch('input', user)
+        return None if form_input is None else json.loads(form_input)
+
+    def get_profile(self, user: str) -> dict | None:
+        profile = self.fetch('profile', user)
+        return None if profile is None else json.loads(profile)
+
+    def save_input(self, user: str, form_input: dict) -> None:
+        with span('db_write'):
+            self.write_input(user, form_input)
+        self.notify(user)
+
+    def write_input(self, user: str, form_input: dict) -> None:
+        self.connect().execute(
+            '''INSERT INTO forms (user, input, profile, state, updated, job)
+               VALUES (?, ?, NULL, 'submitted', ?, NULL)
+               ON CONFLICT (user) DO UPDATE SET
+                   input = excluded.input, profile = NULL,
+                   state = 'submitted', updated = excluded.updated,
+                   job = NULL''',
+            (user, json.dumps(form_input), time.time())
+        )
+
+    def claim_analysis(self, user: str,
+                       job_id: str | None = None) -> Claim:
+        conn = self.connect()
+        now = time.time()
+
+        # Take the write lock up front so only one analysis claims the form
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT state, input, updated FROM forms WHERE user = ?',
+                (user,)
+            ).fetchone()
+            if row is None:
+                conn.execute('COMMIT')
+                return None, None
+
+            state, form_input, updated = row
+            if state == 'analysing' and now - updated > ANALYSIS_TIMEOUT:
+                state = 'submitted'
+
+            if state != 'submitted':
+                conn.execute('COMMIT')
+                return state, None
+
+            conn.execute(
+                '''UPDATE forms SET state = 'analysing', updated = ?, job = ?
+                   WHERE user = ?''',
+                (now, job_id, user)
+            )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        return 'submitted', json.loads(form_input)
+
+    def release_analysis(self, user: str) -> None:
+        self.connect().execute(
+            '''UPDATE forms SET state = 'submitted', updated = ?
+               WHERE user = ? AND state = 'analysing\'''',
+            (time.time(), user)
+        )
+
+    def save_profile(self, user: str, form_input: dict, profile: dict) -> bool:
+        with span('db_write'):
+            saved = self.write_profile(user, profile)
+        if saved:
+            self.notify(user)
+        return saved
+
+    def write_profile(self, user: str, profile: dict) -> bool:
+        cursor = self.connect().execute(
+            '''UPDATE forms SET profile = ?, state = 'analysed', updated = ?
+               WHERE user = ? AND state = 'analysing\'''',
+            (json.dumps(profile), time.time(), user)
+        )
+        return cursor.rowcount == 1
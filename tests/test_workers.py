@@ -0,0 +1,169 @@
+"""
+End-to-end checks of `--workers`: state written through one worker must be
+seen by the others. The server runs on a temporary copy of src/ against the
+stub upstreams of bench/loadtest.py, with `--reuse-port` so that each new
+connection may land on either worker.
+
+Run from the repository root with
+    python -m unittest discover tests
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import unittest
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'bench'))
+
+from loadtest import SRC_DIR, ServerProcess, StubUpstreams, random_form
+
+sys.path.insert(0, SRC_DIR)
+
+from jobs import JOB_PATH, JOB_ID_LENGTH
+
+
+AUTH = ('20005743', '20005743')
+
+# Requests per check, each on a new connection
+N_REQUESTS = 20
+
+
+class WorkersTest(unittest.TestCase):
+    """ The shared JSON form (the default storage) with two workers """
+
+    server_args = ['--workers', '2', '--reuse-port', '--disable-warm-up',
+                   '--pet-prefetch', '0']
+
+    @classmethod
+    def setUpClass(cls):
+        with open(os.path.join(SRC_DIR, 'weights.json'), 'r') as f:
+            cls.jobs = list(json.load(f)['jobs'])
+        cls.stubs = StubUpstreams()
+        cls.stubs.start()
+        cls.server = ServerProcess(cls.server_args, cls.stubs.env())
+        try:
+            cls.server.wait_ready()
+        except RuntimeError:
+            cls.server.stop()
+            cls.stubs.close()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.stubs.close()
+
+    def setUp(self):
+        # With `--sessions`, later requests carry the first one's cookie
+        self.cookies = None
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        # A new connection each time, so requests are spread over workers
+        headers = {'Connection': 'close', **kwargs.pop('headers', {})}
+        response = requests.request(method, f'{self.server.base}{path}',
+                                    auth=AUTH, cookies=self.cookies,
+                                    headers=headers, timeout=10, **kwargs)
+        if self.cookies is None and response.cookies:
+            self.cookies = response.cookies
+        return response
+
+    def submit(self, name: str) -> None:
+        form = random_form(self.jobs)
+        form['name'] = name
+        response = self.request('POST', '/submit', json=form)
+        self.assertEqual(response.status_code, 200)
+
+    def analyse(self) -> requests.Response:
+        return self.request('POST', '/analyze', data=b'null',
+                            headers={'Content-Type': 'application/json'})
+
+    def view_names(self) -> set[str]:
+        names = set()
+        for _ in range(N_REQUESTS):
+            response = self.request('GET', '/view/input')
+            self.assertEqual(response.status_code, 200)
+            names.add(response.json()['name'])
+        return names
+
+    def test_view_follows_writes_of_other_workers(self):
+        self.submit('alice')
+        self.assertEqual(self.view_names(), {'alice'})
+        self.submit('bob')
+        self.assertEqual(self.view_names(), {'bob'})
+
+    def test_analysis_is_seen_by_every_worker(self):
+        self.submit('carol')
+        for _ in range(N_REQUESTS):
+            # Caches that no profile exists on every worker
+            self.assertEqual(self.request('GET', '/view/profile').status_code,
+                             400)
+
+        response = self.analyse()
+        self.assertEqual(response.status_code, 202)
+        location = response.headers['Location']
+
+        # Only one worker may claim the shared form
+        for _ in range(N_REQUESTS // 2):
+            self.assertEqual(self.analyse().status_code, 400)
+
+        # Polls answered by either worker never report a running job failed
+        self.wait_done(location)
+
+        for _ in range(N_REQUESTS):
+            self.assertEqual(self.request('GET', '/view/profile').status_code,
+                             200)
+
+    def test_metrics_are_labelled_by_worker(self):
+        for _ in range(N_REQUESTS):
+            # A scrape only ever covers the worker that answers it
+            workers = set(re.findall(r'worker="(\d+)"',
+                                     self.request('GET', '/metrics').text))
+            stats = self.request('GET', '/stats').json()
+            self.assertLessEqual(workers, {'0', '1'})
+            self.assertLessEqual(len(workers), 1)
+            self.assertIn(stats['worker']['index'], (0, 1))
+
+    def test_only_jobs_of_the_stored_form_are_found(self):
+        self.submit('dave')
+        for _ in range(N_REQUESTS):
+            response = self.request('GET', f'{JOB_PATH}{"x" * JOB_ID_LENGTH}')
+            self.assertEqual(response.status_code, 404)
+
+        location = self.analyse().headers['Location']
+        self.wait_done(location)
+
+        # Once resubmitted, the form no longer tells how the job went. Only
+        # the worker that ran it still knows
+        self.submit('erin')
+        for _ in range(N_REQUESTS):
+            response = self.request('GET', location)
+            if response.status_code != 404:
+                self.assertEqual(response.json()['state'], 'done')
+
+    def wait_done(self, location: str) -> None:
+        deadline = time.monotonic() + 30
+        while True:
+            self.assertLess(time.monotonic(), deadline)
+            response = self.request('GET', location)
+            self.assertEqual(response.status_code, 200)
+            state = response.json()['state']
+            self.assertNotEqual(state, 'failed')
+            if state == 'done':
+                return
+            time.sleep(0.05)
+
+
+class SQLiteWorkersTest(WorkersTest):
+    """ The same with a form per session in SQLite """
+
+    server_args = WorkersTest.server_args + ['--storage', 'sqlite',
+                                             '--sessions']
+
+
+if __name__ == '__main__':
+    unittest.main()